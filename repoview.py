@@ -35,52 +35,112 @@ directory, to make it easily browseable.
 __revision__ = '$Id$'
 
 import os
+import re
 import shutil
 import sys
 import time
 import hashlib
+import importlib
+import io
+import json
 import functools
-import rpm
+import copy
+import queue
+import builtins
+import threading
 
-from optparse import OptionParser
+# genshi, rpm and libcomps, as well as the heavier standard modules that
+# only some runs need (tarfile, zipfile, concurrent.futures, ast, textwrap,
+# configparser), are imported where they are used, see _require. Keep it
+# that way: "python -X importtime -c 'import repoview'" should not list
+# them (tests/test_startup.py checks). optparse, which pulls in textwrap,
+# is only imported by main().
 
-try:
-    from genshi.template import TemplateLoader  # type: ignore[import]
-except ImportError as exc:
-    raise ImportError('Repoview requires the "genshi" package.') from exc
-
-from xml.etree.ElementTree import fromstring, ElementTree, TreeBuilder
+from xml.etree.ElementTree import fromstring, tostring, TreeBuilder, iterparse
 
 import sqlite3 as sqlite
 
-try:
-    import libcomps  # type: ignore[import]
-except ImportError:
-    libcomps = None  # type: ignore[assignment]
-
 ##
 # Some hardcoded constants
 #
 PKGKID    = 'package.kid'
 PKGFILE   = '%s.html'
+PKGDIR    = 'pkgs'
 GRPKID    = 'group.kid'
 GRPFILE   = '%s.group.html'
+GRPPAGE   = '%s+%s.group.html'
+HISTFILE  = '%s.changelog.html'
+CATFILE   = '%s.category.html'
+ENVFILE   = '%s.environment.html'
+COMPSCACHE = 'comps.json'
+HISTBATCH = 256
 IDXKID    = 'index.kid'
 IDXFILE   = 'index.html'
 RSSKID    = 'rss.kid'
 RSSFILE   = 'latest-feed.xml'
+ATOMFILE  = 'latest-feed.atom'
+JSONFILE  = 'latest-feed.json'
+FEEDFILES = {'rss': RSSFILE, 'atom': ATOMFILE, 'json': JSONFILE}
+MANIFEST  = 'manifest.txt'
+ARCHIVE   = 'repoview.%s'
+OBJDIR    = 'objects'
+OBJMANIFEST = 'objects.manifest'
+DELTAFILE = 'manifest-delta.txt'
 ISOFORMAT = '%a, %d %b %Y %H:%M:%S %z'
+RFC3339   = '%Y-%m-%dT%H:%M:%SZ'
+LATEST    = 30
+FIELDSINI = 'fields.ini'
+
+# The pkg_data keys and the members of the pkg_data['rpms'] tuples that are
+# only looked up when the templates use them. Any other pkg_data key, as well
+# as epoch, version, release, arch and time_build, is always there.
+PKG_FIELDS = {
+    'description':   'description',
+    'url':           'url',
+    'rpm_license':   'rpm_license',
+    'rpm_sourcerpm': 'rpm_sourcerpm',
+    'vendor':        'rpm_vendor',
+}
+RPM_FIELDS = ('epoch', 'version', 'release', 'arch', 'time_build', 'size',
+              'location_href', 'author', 'changelog', 'time_added')
+RPM_COLUMNS = {
+    'size':          'size_package',
+    'location_href': 'location_href',
+}
+CHANGELOG_FIELDS = frozenset(['author', 'changelog', 'time_added'])
+ALL_FIELDS = frozenset(PKG_FIELDS) | frozenset(RPM_FIELDS)
 
 VERSION = '0.7.1'
 SUPPORTED_DB_VERSION = 10
 DEFAULT_TEMPLATEDIR = '/usr/share/repoview/templates/default'
 
-# High-level execution pipeline (mirrored by the inline "Phase" comments below):
-#   1. Parse CLI arguments (main) and instantiate Repoview.
-#   2. Locate repository assets, prepare output/state directories, build exclusion SQL.
-#   3. Build group definitions (comps, RPM groups, letter groups) and render package pages.
-#   4. Render aggregate views (group pages, index, optional RSS).
-#   5. Persist incremental state and delete artifacts from previous runs.
+# High-level execution pipeline (mirrored by the Repoview session methods):
+#   1. Parse CLI arguments (main), load RepoMetadata and open a Repoview per view.
+#   2. load(): prepare output/state directories and layout, build exclusion SQL.
+#   3. plan(): build group definitions (comps, RPM groups, letter groups).
+#   4. render(): render package and group pages, then aggregate views (index, optional RSS).
+#   5. finalize(): persist incremental state and delete artifacts from previous runs.
+
+def _require(module, package):
+    """
+    Import a dependency when the phase that needs it runs, rather than when
+    repoview starts, so that --help, --version and no-op runs do not pay
+    for it.
+
+    @param  module: the module to import, e.g. "genshi.template"
+    @type   module: str
+    @param package: the package providing it, for the error message
+    @type  package: str
+
+    @return: the module
+    @rtype:  module
+
+    @raise ImportError: if the package is not installed
+    """
+    try:
+        return importlib.import_module(module)
+    except ImportError as exc:
+        raise ImportError('Repoview requires the "%s" package.' % package) from exc
 
 def _mkid(text):
     """
@@ -114,6 +174,279 @@ def _humansize(num_bytes):
         return f'{kbytes:d} KiB'
     return f'{float(kbytes)/1024:0.1f} MiB'
 
+def _page_break(pkgname, page_size):
+    """
+    Decide whether a group page may end after this package.
+
+    The decision depends only on the package name, so page boundaries stay
+    put when unrelated packages are added to or removed from the group.
+    Candidates are a bit more frequent than one in page_size, as _paginate
+    drops those that follow another one too closely.
+
+    @param pkgname:   the name of the package
+    @type  pkgname:   str
+    @param page_size: the average number of packages per page
+    @type  page_size: int
+
+    @return: True if a new page may start after this package
+    @rtype:  bool
+    """
+    digest = hashlib.md5(pkgname.encode()).hexdigest()
+    return int(digest[:8], 16) % max(1, page_size * 2 // 3) == 0
+
+def _paginate(packages, page_size):
+    """
+    Split a sorted list of package tuples into pages using name-derived
+    boundaries (see _page_break). A candidate is dropped if one of the
+    page_size / 4 packages before it is a candidate too, so pages do not
+    get much smaller than that; as this only looks at the neighbouring
+    names, a package added or removed moves at most the boundaries right
+    next to it. Pages are capped at four times the page size, to keep
+    unlucky runs of names from producing huge pages.
+
+    @param packages:  list of (pkg_name, pkg_filename, pkg_summary) tuples
+    @type  packages:  list
+    @param page_size: the average number of packages per page
+    @type  page_size: int
+
+    @return: a list of lists of package tuples
+    @rtype:  list
+    """
+    candidates = [_page_break(pkg_tuple[0], page_size)
+                  for pkg_tuple in packages]
+    window = page_size // 4
+    pages = []
+    page = []
+    for (index, pkg_tuple) in enumerate(packages):
+        page.append(pkg_tuple)
+        if ((candidates[index]
+                and not any(candidates[max(0, index - window):index]))
+                or len(page) >= page_size * 4):
+            pages.append(page)
+            page = []
+    if page:
+        pages.append(page)
+    return pages
+
+def _template_fields(templatedir, kids):
+    """
+    Work out which pkg_data fields (see PKG_FIELDS and RPM_FIELDS) the given
+    templates use. A template set can declare them in fields.ini:
+
+        [fields]
+        pkg_data = description url
+        rpms = size location_href
+
+    Otherwise the expressions in the templates are scanned for pkg_data['key']
+    lookups and for the names the py:for loops over pkg_data['rpms'] bind.
+    Anything the scan cannot follow (pkg_data handed to a function, rpms
+    indexed by position, templates pulled in with xi:include, py:def,
+    py:match or any directive other than for, if, content, replace and
+    strip...) means all fields are used.
+
+    @param templatedir: the template directory
+    @type  templatedir: str
+    @param        kids: the templates that are handed pkg_data
+    @type         kids: list
+
+    @return: the names of the fields used
+    @rtype:  frozenset
+    """
+    fieldsini = os.path.join(templatedir, FIELDSINI)
+    if os.access(fieldsini, os.R_OK):
+        from configparser import ConfigParser, Error as ConfigError
+        config = ConfigParser()
+        try:
+            config.read(fieldsini)
+            fields = (config.get('fields', 'pkg_data', fallback='').split() +
+                      config.get('fields', 'rpms', fallback='').split())
+        except ConfigError as exc:
+            raise ValueError('%s: %s' % (fieldsini, exc)) from exc
+        unknown = set(fields) - ALL_FIELDS - {'name', 'filename', 'summary'}
+        if unknown:
+            raise ValueError('%s: unknown fields %s'
+                             % (fieldsini, ', '.join(sorted(unknown))))
+        return frozenset(fields)
+
+    fields = set()
+    for kid in kids:
+        try:
+            with open(os.path.join(templatedir, kid), encoding='utf-8') as fh:
+                text = fh.read()
+        except OSError:
+            continue
+        # other files, macros and match templates may use pkg_data in ways
+        # we cannot see from here; so may the element form of directives
+        if 'http://www.w3.org/2001/XInclude' in text or '<py:' in text:
+            return ALL_FIELDS
+        directives = set(re.findall(r'\bpy:(\w+)\s*=', text))
+        if directives - TemplateCompiler.DIRECTIVE:
+            return ALL_FIELDS
+        # the Python bits of the template
+        exprs = re.findall(r'\$\{(.*?)\}|\$([A-Za-z_][\w.]*)|'
+                           r'py:\w+\s*=\s*"([^"]*)"|<\?python(.*?)\?>',
+                           text, re.S)
+        exprs = [''.join(groups) for groups in exprs]
+        code = '\n'.join(exprs)
+        keys = re.findall(r'pkg_data\s*\[\s*[\'"](\w+)[\'"]\s*\]', code)
+        if len(keys) != len(re.findall(r'\bpkg_data\b', code)):
+            return ALL_FIELDS
+        fields.update(keys)
+        loops = [re.match(r'\s*\(?([\w\s,]*?)\)?\s+in\s+'
+                          r'pkg_data\s*\[\s*[\'"]rpms[\'"]\s*\]\s*$', expr)
+                 for expr in exprs]
+        loops = [loop for loop in loops if loop is not None]
+        if len(loops) != keys.count('rpms'):
+            return ALL_FIELDS
+        for loop in loops:
+            names = [name.strip() for name in loop.group(1).split(',')]
+            if len(names) != len(RPM_FIELDS):
+                return ALL_FIELDS
+            rest = code.replace(loop.group(0), '')
+            for (name, field) in zip(names, RPM_FIELDS):
+                if re.search(r'\b%s\b' % re.escape(name), rest):
+                    fields.add(field)
+    return frozenset(fields)
+
+def _install_file(src, dst):
+    """
+    Put a copy of src at dst, replacing dst atomically. A hardlink is used
+    when possible, then a reflink (on filesystems that support FICLONE),
+    falling back to a plain copy.
+
+    @param src: the source file
+    @type  src: str
+    @param dst: the destination file
+    @type  dst: str
+
+    @rtype: void
+    """
+    tmpfile = '%s.tmp' % dst
+    if os.path.lexists(tmpfile):
+        os.unlink(tmpfile)
+    # os.link would link a symlink itself, whose relative target (e.g. in
+    # kaos-international) does not resolve from the output directory
+    src = os.path.realpath(src)
+    try:
+        os.link(src, tmpfile)
+    except OSError:
+        try:
+            import fcntl
+            ficlone = 0x40049409
+            with open(src, 'rb') as fsrc, open(tmpfile, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), ficlone, fsrc.fileno())
+            shutil.copymode(src, tmpfile)
+        except (ImportError, OSError):
+            shutil.copy2(src, tmpfile)
+    os.replace(tmpfile, dst)
+
+def _state_file(opts, name):
+    """
+    Return where a state file of a view goes: in the output directory, or,
+    with --state-dir, in that directory under a name made unique by the
+    md5sum of the output directory, so that several repositories can share
+    it.
+
+    @param opts: OptionParser's opts (repodir, outdir and statedir are used)
+    @type  opts: OptionParser
+    @param name: the name of the state file, e.g. "state.sqlite"
+    @type  name: str
+
+    @rtype: str
+    """
+    outdir = os.path.join(opts.repodir, opts.outdir)
+    if opts.statedir:
+        unique = '%s.%s' % (hashlib.md5(outdir.encode()).hexdigest(), name)
+        return os.path.join(opts.statedir, unique)
+    return os.path.join(outdir, name)
+
+def _parse_comps(compsxml):
+    """
+    Read the groups, categories and environments from comps.xml, one
+    element at a time, so that even Fedora's comps never sits in memory as
+    a whole. This is what is used when libcomps is not available; the
+    results are the same as those of _libcomps_parse. Translated names and
+    descriptions (xml:lang) are ignored.
+
+    @param compsxml: the location of comps.xml
+    @type  compsxml: str
+
+    @return: {'groups': [(id, name, description, pkgnames)],
+              'categories': [(id, name, description, groupids)],
+              'environments': [(id, name, description, groupids,
+                                optionids)]}
+    @rtype:  dict
+    """
+    lang = '{http://www.w3.org/XML/1998/namespace}lang'
+
+    def text(elem, tag):
+        for child in elem.findall(tag):
+            if lang not in child.attrib:
+                return (child.text or '').strip()
+        return None
+
+    def ids(elem, path):
+        return [(child.text or '').strip() for child in elem.findall(path)]
+
+    comps = {'groups': [], 'categories': [], 'environments': []}
+    root = None
+    depth = 0
+    for (event, elem) in iterparse(compsxml, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+        depth -= 1
+        if depth != 1:
+            continue
+        if elem.tag == 'group':
+            comps['groups'].append((text(elem, 'id'), text(elem, 'name'),
+                                    text(elem, 'description'),
+                                    ids(elem, 'packagelist/packagereq')))
+        elif elem.tag == 'category':
+            comps['categories'].append((text(elem, 'id'), text(elem, 'name'),
+                                        text(elem, 'description'),
+                                        ids(elem, 'grouplist/groupid')))
+        elif elem.tag == 'environment':
+            comps['environments'].append((text(elem, 'id'),
+                                          text(elem, 'name'),
+                                          text(elem, 'description'),
+                                          ids(elem, 'grouplist/groupid'),
+                                          ids(elem, 'optionlist/groupid')))
+        # done with it
+        root.clear()
+    return comps
+
+def _libcomps_parse(compsxml):
+    """
+    Read the groups, categories and environments from comps.xml with
+    libcomps.
+
+    @param compsxml: the location of comps.xml
+    @type  compsxml: str
+
+    @return: the same as _parse_comps
+    @rtype:  dict
+
+    @raise ImportError: if libcomps is not installed
+    """
+    import libcomps  # type: ignore[import]
+    comps = libcomps.Comps()
+    comps.fromxml_f(compsxml)
+    return {
+        'groups': [(group.id, group.name, group.desc,
+                    [pkg.name for pkg in group.packages])
+                   for group in comps.groups],
+        'categories': [(category.id, category.name, category.desc,
+                        [gid.name for gid in category.group_ids])
+                       for category in comps.categories],
+        'environments': [(env.id, env.name, env.desc,
+                          [gid.name for gid in env.group_ids],
+                          [gid.name for gid in env.option_ids])
+                         for env in comps.environments],
+    }
+
 def _compare_evra(one, two):
     """
     Comparison helper for sorting packages by EVR (Epoch, Version, Release).
@@ -132,267 +465,2030 @@ def _compare_evra(one, two):
     evr_one = (str(one[0]), one[1], one[2])
     evr_two = (str(two[0]), two[1], two[2])
 
-    return rpm.labelCompare(evr_one, evr_two)
+    return _require('rpm', 'rpm').labelCompare(evr_one, evr_two)
 
-class Repoview:
+class BackgroundWriter:
     """
-    The main controller class for Repoview.
-    
-    This class handles the entire workflow:
-    1. initializing repository connections and state database,
-    2. processing groups and packages,
-    3. managing incremental builds via checksums,
-    4. rendering templates using Genshi,
-    5. and generating the final HTML output and RSS feeds.
+    Write files on a few worker threads, so that querying and rendering the
+    next page overlaps with the write and close of the previous ones. Each
+    file is routed to a thread by its name, so successive writes of the same
+    file keep their order. Queues are bounded, to keep the rendered pages
+    waiting in memory in check. The first error raised by a worker is
+    re-raised by the next submit() or flush().
     """
 
-    def __del__(self):
-        for entry in self.cleanup:
-            if os.access(entry, os.W_OK):
-                os.unlink(entry)
+    def __init__(self, threads, depth=64):
+        """
+        @param threads: the number of writer threads; 0 writes synchronously
+        @type  threads: int
+        @param   depth: how many files can wait in each thread's queue
+        @type    depth: int
+        """
+        self.errors  = []
+        self.queues  = []
+        self.threads = []
+        for _ in range(threads):
+            wqueue = queue.Queue(depth)
+            thread = threading.Thread(target=self._work, args=(wqueue,),
+                                      daemon=True)
+            thread.start()
+            self.queues.append(wqueue)
+            self.threads.append(thread)
+
+    @staticmethod
+    def write(path, content, atomic=False):
+        """
+        Write content to path, creating the parent directory if needed.
+
+        @param    path: the file to write
+        @type     path: str
+        @param content: the file contents
+        @type  content: bytes
+        @param  atomic: write to a temporary file and rename it to path
+        @type   atomic: bool
 
-    def __init__(self, opts):
+        @rtype: void
         """
-        @param opts: OptionParser's opts
-        @type  opts: OptionParser
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        target = path
+        if atomic:
+            path = '%s.%d.tmp' % (target, threading.get_ident())
+        with open(path, 'wb') as f:
+            f.write(content)
+        if atomic:
+            os.replace(path, target)
+
+    def _work(self, wqueue):
+        while True:
+            item = wqueue.get()
+            try:
+                if item is None:
+                    break
+                self.write(*item)
+            except Exception as exc: #IGNORE:W0703
+                self.errors.append(exc)
+            finally:
+                wqueue.task_done()
+
+    def _check(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def submit(self, path, content, atomic=False):
         """
-        # The constructor orchestrates the full build pipeline up front so that
-        # later helper methods can assume all shared state (database handles,
-        # exclusion SQL, template loaders, etc.) already exists.
-        # The initialization order below mirrors the chronological order of a
-        # repoview run: collect inputs → prepare filesystem → prepare state →
-        # compute grouping metadata → render pages → persist state.
-        # list of files to remove at the end of processing
-        self.cleanup = []
-        self.opts    = opts
-        # Honor the CLI-provided output directory name (defaults to "repoview")
-        # but always treat it as a subdirectory of the repository root.
-        self.outdir  = os.path.join(opts.repodir, opts.outdir)
+        Queue a file to be written, blocking if that thread's queue is full.
 
-        self.exclude    = '1=1'
-        # Dictionary storing filename -> checksum mapping from the state database (previous run).
-        # Used to determine if a file needs to be regenerated.
-        self.state_data = {} 
-        # Dictionary tracking packages processed in the current run to handle duplicates
-        # and avoid re-processing. Maps pkgname -> pkg_tuple.
-        self.written    = {} 
+        @param    path: the file to write
+        @type     path: str
+        @param content: the file contents
+        @type  content: bytes
+        @param  atomic: see write()
+        @type   atomic: bool
 
-        self.groups        = []
-        self.letter_groups = []
+        @rtype: void
+        """
+        self._check()
+        if not self.queues:
+            self.write(path, content, atomic)
+            return
+        index = int(hashlib.md5(path.encode()).hexdigest()[:8], 16)
+        self.queues[index % len(self.queues)].put((path, content, atomic))
+
+    def flush(self):
+        """
+        Wait until every queued file has been written.
 
-        self.pconn = None # primary.sqlite
-        self.oconn = None # other.sqlite
-        self.sconn = None # state db
+        @rtype: void
+        """
+        for wqueue in self.queues:
+            wqueue.join()
+        self._check()
 
-        # Phase 1: locate repository metadata, initialize database handles.
-        self.setup_repo()
-        # Phase 2: prepare filesystem targets and incremental build state.
-        self.setup_outdir()
-        self.setup_state_db()
-        self.setup_excludes()
+    def close(self):
+        """
+        Write out what is still queued and stop the threads. Errors are not
+        raised here; call flush() first to see them.
 
-        if not self.groups:
-            self.setup_rpm_groups()
+        @rtype: void
+        """
+        for wqueue in self.queues:
+            wqueue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.queues = []
+        self.threads = []
+
+class DirectorySink:
+    """
+    Where the generated site goes. This one, the default, writes it as
+    plain files into the output directory, using a BackgroundWriter.
+
+    Sinks are handed paths relative to the output directory, with "/" as
+    separator, along with the sha256 of the contents. Files that are not
+    written again stay as they are until remove() is called, and nothing
+    is published for sure before commit(), which gets the complete list
+    of files the site is made of.
+    """
 
-        letters = self.setup_letter_groups()
+    name = 'dir'
 
-        repo_data = {
-                     'title':      opts.title,
-                     'letters':    letters,
-                     'my_version': VERSION
-                    }
-        # Template engine handles page rendering.  Each TemplateLoader instance can cache
-        # compiled templates, so we keep dedicated loaders for packages and groups to
-        # avoid cross-assignment of contextual attributes.
-        group_kid = TemplateLoader(opts.templatedir)
-        self.group_kid = group_kid
+    def __init__(self, outdir, writers):
+        """
+        @param  outdir: the output directory
+        @type   outdir: str
+        @param writers: the number of writer threads (see BackgroundWriter)
+        @type  writers: int
+        """
+        self.outdir = outdir
+        self.writer = BackgroundWriter(writers)
 
-        pkg_kid = TemplateLoader(opts.templatedir)
-        self.pkg_kid = pkg_kid
+    def path(self, filename):
+        return os.path.join(self.outdir, filename)
 
-        count = 0
-        # Phase 3: Iterate through all logical groups (explicit comps groups plus
-        # auto-generated alphabetical "Letter" buckets).  Each iteration renders
-        # the packages belonging to the group, wires them into group metadata, and
-        # produces the HTML if any of the constituent checksums changed.
-        for group_data in self.groups + self.letter_groups:
-            (grp_name, grp_filename, grp_description, pkgnames) = group_data
-            pkgnames.sort()
+    def lost(self):
+        """
+        Tell whether the published files went missing while the state db
+        stayed around, in which case everything has to be written again.
 
-            group_data = {
-                          'name':        grp_name,
-                          'description': grp_description,
-                          'filename':    grp_filename,
-                          }
+        @rtype: bool
+        """
+        return False
 
-            # Package pages double as a cache warm-up for group pages: the call returns
-            # summary tuples used on the group listing while also writing/refining the
-            # individual package HTML files.
-            packages = self.do_packages(repo_data, group_data, pkgnames)
+    def exists(self, filename, digest=None):
+        """
+        Tell whether a file is there, and (for sinks that know) whether it
+        has the given digest.
 
-            if not packages:
-                # Empty groups are ignored
-                del self.groups[count]
-                continue
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param   digest: the sha256 the file should have, if known
+        @type    digest: str
 
-            count += 1
+        @rtype: bool
+        """
+        return os.path.exists(self.path(filename))
 
-            group_data['packages'] = packages
+    def read(self, filename):
+        """
+        Return the contents of a file written by an earlier run.
 
-            checksum = self.mk_checksum(repo_data, group_data)
-            if self.has_changed(grp_filename, checksum):
-                # write group file
-                self.say('Writing group %s\n' % grp_filename)
-                self.group_kid.group_data = group_data
-                outfile = os.path.join(self.outdir, grp_filename)
+        @param filename: the filename relative to the output directory
+        @type  filename: str
 
-                tmpl= self.group_kid.load( GRPKID )
+        @rtype: bytes
+        """
+        with open(self.path(filename), 'rb') as f:
+            return f.read()
 
-                stream=tmpl.generate(group_data=group_data, repo_data=repo_data)
-                with open( outfile, "w" ) as f:
-                   f.write( stream.render('xhtml', doctype='xhtml-strict'))
+    def list(self):
+        """
+        List the files there are, e.g. to recover the state db.
 
-        # Phase 4: Build aggregated views (latest packages list, index page, optional RSS).
-        latest = self.get_latest_packages()
-        repo_data['latest'] = latest
-        repo_data['groups'] = self.groups
+        @rtype: list
+        """
+        filenames = []
+        for (dirpath, dirnames, files) in os.walk(self.outdir):
+            dirnames.sort()
+            for name in sorted(files):
+                path = os.path.relpath(os.path.join(dirpath, name), self.outdir)
+                filenames.append(path.replace(os.sep, '/'))
+        return filenames
+
+    def write(self, filename, content, digest):
+        """
+        Write a file, possibly in the background (see flush).
 
-        checksum = self.mk_checksum(repo_data)
-        if self.has_changed('index.html', checksum):
-            # Write index.html and rss feed (if asked)
-            self.say('Writing index.html...')
-            idx_tpt = os.path.join(self.opts.templatedir, IDXKID)
-            idx_kid = TemplateLoader(self.opts.templatedir)
-            idx_kid.url = self.opts.url
-            idx_kid.latest = latest
-            idx_kid.groups = self.groups
-            outfile = os.path.join(self.outdir, 'index.html')
-
-            tmpl= idx_kid.load( IDXKID  )
-
-            stream=tmpl.generate( repo_data = repo_data, url=self.opts.url, groups = self.groups, latest = latest )
-            with open( outfile, "w" ) as f:
-               f.write( stream.render('xhtml', doctype='xhtml-strict'))
-            self.say('done\n')
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param  content: the file contents
+        @type   content: bytes
+        @param   digest: the sha256 of the contents
+        @type    digest: str
 
-            # rss feed
-            if self.opts.url:
-                self.do_rss(repo_data, latest)
+        @rtype: void
+        """
+        self.writer.submit(self.path(filename), content)
 
-        # Phase 5: Delete orphaned files and persist state so the next run can stay incremental.
-        self.remove_stale()
-        self.sconn.commit()
+    def install(self, filename, src, content, digest):
+        """
+        Install a copy of a file, e.g. a layout asset.
 
-    def setup_state_db(self):
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param      src: the file to install
+        @type       src: str
+        @param  content: its contents
+        @type   content: bytes
+        @param   digest: the sha256 of the contents
+        @type    digest: str
+
+        @rtype: void
         """
-        Initializes the SQLite database used for incremental build state tracking.
-        
-        The database stores checksums of previously generated files to avoid 
-        unnecessary writes. If a specific state directory is not provided, 
-        it creates 'state.sqlite' in the output directory.
+        dst = self.path(filename)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        _install_file(src, dst)
+
+    def rename(self, filename, target):
+        """
+        Move a file written by an earlier run.
+
+        @param filename: the current filename
+        @type  filename: str
+        @param   target: the new filename
+        @type    target: str
 
         @rtype: void
         """
-        self.say('Examining state db...')
-        if self.opts.statedir:
-            # we'll use the md5sum of the repo location to make it unique
-            # among multiple repositories sharing the same statedir.
-            unique = '%s.state.sqlite' % hashlib.md5(self.outdir.encode()).hexdigest()
-            statedb = os.path.join(self.opts.statedir, unique)
-        else:
-            statedb = os.path.join(self.outdir, 'state.sqlite')
+        source = self.path(filename)
+        if os.access(source, os.W_OK):
+            destination = self.path(target)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            os.rename(source, destination)
+            self.prune_dirs(os.path.dirname(source))
+
+    def remove(self, filename):
+        """
+        Remove a file that is no longer part of the site.
 
-        if os.access(statedb, os.W_OK):
-            if self.opts.force:
-                # clean slate -- remove state db and start over
-                os.unlink(statedb)
-        else:
-            # state_db not found, go into force mode
-            self.opts.force = True
+        @param filename: the filename relative to the output directory
+        @type  filename: str
 
-        self.sconn = sqlite.connect(statedb)
-        scursor = self.sconn.cursor()
+        @rtype: void
+        """
+        fullpath = self.path(filename)
+        if os.access(fullpath, os.W_OK):
+            os.unlink(fullpath)
+            if '/' in filename:
+                self.prune_dirs(os.path.dirname(fullpath))
 
-        query = """CREATE TABLE IF NOT EXISTS state (
-                          filename TEXT UNIQUE,
-                          checksum TEXT)"""
-        scursor.execute(query)
+    def prune_dirs(self, dirname):
+        """
+        Remove now-empty subdirectories, up to the output directory.
 
-        # read all state data into memory to track orphaned files
-        query = """SELECT filename, checksum FROM state"""
-        scursor.execute(query)
-        while True:
-            row = scursor.fetchone()
-            if row is None:
+        @param dirname: the directory a file was just removed from
+        @type  dirname: str
+
+        @rtype: void
+        """
+        while os.path.normpath(dirname) != os.path.normpath(self.outdir):
+            try:
+                os.rmdir(dirname)
+            except OSError:
                 break
-            self.state_data[row[0]] = row[1]
-        self.say('done\n')
+            dirname = os.path.dirname(dirname)
 
-    def setup_repo(self):
+    def flush(self):
         """
-        Validates the repository structure and initializes database connections.
-        
-        It parses 'repodata/repomd.xml' to locate the 'primary' (packages) and 
-        'other' (changelogs) SQLite databases, as well as the 'group' (comps) file.
-        It also checks for schema version compatibility.
+        Wait until everything written so far is out.
 
         @rtype: void
         """
-        self.say('Examining repository...')
-        repomd = os.path.join(self.opts.repodir, 'repodata', 'repomd.xml')
+        self.writer.flush()
 
-        if not os.access(repomd, os.R_OK):
-            sys.stderr.write('Not found: %s\n' % repomd)
-            sys.stderr.write('Does not look like a repository. Exiting.\n')
-            sys.exit(1)
+    def commit(self, files):
+        """
+        Publish the site. Nothing left to do for plain files.
 
-        repoxml = open(repomd).read()
+        @param files: (filename, digest) for every file of the site
+        @type  files: list
 
-        xml = fromstring(repoxml) #IGNORE:E1101
-        # look for primary_db, other_db, and optionally group
+        @rtype: void
+        """
+        self.flush()
 
-        primary = other = comps = dbversion = None
+    def close(self):
+        """
+        Stop the writer threads. Whatever was not committed may or may not
+        have been published.
 
-        xmlns = 'http://linux.duke.edu/metadata/repo'
-        for datanode in xml.findall('{%s}data' % xmlns):
-            href = datanode.find('{%s}location' % xmlns).attrib['href']
-            if datanode.attrib['type'] == 'primary_db':
-                primary = os.path.join(self.opts.repodir, href)
-                dbversion = datanode.find('{%s}database_version' % xmlns).text
-            elif datanode.attrib['type'] == 'other_db':
-                other = os.path.join(self.opts.repodir, href)
-            elif datanode.attrib['type'] == 'group':
-                comps = os.path.join(self.opts.repodir, href)
+        @rtype: void
+        """
+        self.writer.close()
 
-        if primary is None or dbversion is None:
-            self.say('Sorry, sqlite files not found in the repository.\n'
-                     'Please rerun createrepo with a -d flag and try again.\n')
-            sys.exit(1)
+class ArchiveSink(DirectorySink):
+    """
+    Stream the site into a tar or zip archive in the output directory
+    (ARCHIVE). Pages are appended to a new archive as they are written;
+    commit() adds the unchanged files from the previous archive and then
+    renames the new one over it, so the site changes over atomically and
+    the served directory never sees 100k small files.
+    """
 
-        if int(dbversion) > SUPPORTED_DB_VERSION:
-            self.say('Sorry, the db_version in the repository is %s, but '
-                     'repoview only supports versions up to %s. Please check '
-                     'for a newer repoview version.\n' % (dbversion,
-                                                          SUPPORTED_DB_VERSION))
-            sys.exit(1)
+    name = 'tar'
 
-        self.say('done\n')
+    def __init__(self, outdir, writers):
+        """
+        @param  outdir: the output directory
+        @type   outdir: str
+        @param writers: ignored, archives are written in order
+        @type  writers: int
+        """
+        DirectorySink.__init__(self, outdir, 0)
+        self.archive = os.path.join(outdir, ARCHIVE % self.name)
+        self.old = None      # the published archive, opened for reading
+        self.new = None      # the archive being written
+        self.names = {}      # member name -> member info of the old one
+        self.written = set()
+        self.renames = {}
+
+    def lost(self):
+        return not os.path.exists(self.archive)
+
+    def open_old(self):
+        if self.old is None and os.path.exists(self.archive):
+            self.old = self.open_archive(self.archive, 'r')
+        return self.old
+
+    def exists(self, filename, digest=None):
+        if filename in self.written:
+            return True
+        old = self.open_old()
+        return old is not None and self.renames.get(filename, filename) in self.names
+
+    def read(self, filename):
+        return self.read_member(self.renames.get(filename, filename))
+
+    def list(self):
+        if self.open_old() is None:
+            return []
+        return sorted(self.names)
+
+    def write(self, filename, content, digest):
+        if self.new is None:
+            self.open_old()
+            self.new = self.open_archive('%s.tmp' % self.archive, 'w')
+        self.add_member(filename, content)
+        self.written.add(filename)
+
+    def install(self, filename, src, content, digest):
+        self.write(filename, content, digest)
+
+    def rename(self, filename, target):
+        self.renames[target] = self.renames.pop(filename, filename)
+
+    def remove(self, filename):
+        # simply not carried over into the next archive
+        pass
+
+    def commit(self, files):
+        if self.new is None and not self.renames and self.open_old() is not None:
+            if set(self.names) == set([filename for (filename, _) in files]):
+                # nothing changed
+                return
+        if self.new is None:
+            self.open_old()
+            self.new = self.open_archive('%s.tmp' % self.archive, 'w')
+        for (filename, _) in files:
+            if filename not in self.written:
+                self.add_member(filename, self.read(filename))
+        self.close_archives()
+        os.replace('%s.tmp' % self.archive, self.archive)
+        self.written = set()
+        self.renames = {}
+
+    def close(self):
+        self.close_archives()
+        if os.path.exists('%s.tmp' % self.archive):
+            os.unlink('%s.tmp' % self.archive)
+
+    def close_archives(self):
+        for archive in (self.old, self.new):
+            if archive is not None:
+                archive.close()
+        self.old = self.new = None
+
+    # the tar specifics
+    def open_archive(self, path, mode):
+        import tarfile
+        archive = tarfile.open(path, mode)
+        if mode == 'r':
+            self.names = dict([(member.name, member)
+                               for member in archive.getmembers()])
+        return archive
+
+    def read_member(self, name):
+        self.open_old()
+        return self.old.extractfile(self.names[name]).read()
+
+    def add_member(self, name, content):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        self.new.addfile(info, io.BytesIO(content))
+
+class ZipSink(ArchiveSink):
+    """
+    Like ArchiveSink, but producing a zip archive, which can be served
+    without unpacking it.
+    """
 
-        self.say('Opening primary database...')
-        primary = self.z_handler(primary)
-        self.pconn = sqlite.connect(primary)
-        self.say('done\n')
+    name = 'zip'
+
+    def open_archive(self, path, mode):
+        import zipfile
+        archive = zipfile.ZipFile(path, mode, zipfile.ZIP_DEFLATED)
+        if mode == 'r':
+            self.names = dict([(name, None) for name in archive.namelist()])
+        return archive
+
+    def read_member(self, name):
+        self.open_old()
+        return self.old.read(name)
+
+    def add_member(self, name, content):
+        import zipfile
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.new.writestr(info, content)
+
+class ObjectSink(DirectorySink):
+    """
+    Keep the site in a content-addressed store: every file is written once,
+    as objects/xx/<sha256>, and OBJMANIFEST maps each path of the site to
+    its object. Replacing OBJMANIFEST (atomically) is what publishes a new
+    version of the site. Objects referenced by neither the new nor the
+    previous manifest are deleted at commit time, so readers that still
+    use the previous manifest keep working.
+    """
+
+    name = 'objects'
+
+    def __init__(self, outdir, writers):
+        DirectorySink.__init__(self, outdir, writers)
+        self.objdir = os.path.join(outdir, OBJDIR)
+        self.manifest = os.path.join(outdir, OBJMANIFEST)
+        # path -> sha256 as published
+        self.index = {}
+        if os.path.exists(self.manifest):
+            with open(self.manifest, encoding='utf-8') as f:
+                for line in f:
+                    if not line.startswith('#'):
+                        (digest, filename) = line.rstrip('\n').split(' ', 1)
+                        self.index[filename] = digest
+        # path -> sha256 as of this run: the index, plus what was written,
+        # renamed or removed since
+        self.paths = dict(self.index)
+        self.pending = set()
+
+    def object_path(self, digest):
+        return os.path.join(self.objdir, digest[:2], digest[2:])
+
+    def lost(self):
+        return not os.path.exists(self.manifest)
+
+    def has_object(self, digest):
+        return (digest in self.pending
+                or os.path.exists(self.object_path(digest)))
+
+    def exists(self, filename, digest=None):
+        # the same contents under another path do not count
+        current = self.paths.get(filename)
+        if current is None or (digest is not None and current != digest):
+            return False
+        return self.has_object(current)
+
+    def read(self, filename):
+        digest = self.paths[filename]
+        if digest in self.pending:
+            self.flush()
+        with open(self.object_path(digest), 'rb') as f:
+            return f.read()
+
+    def list(self):
+        return sorted(self.index)
+
+    def write(self, filename, content, digest):
+        self.paths[filename] = digest
+        if self.has_object(digest):
+            return
+        self.pending.add(digest)
+        # written under a temporary name first, so that an object that
+        # exists is always complete
+        self.writer.submit(self.object_path(digest), content, atomic=True)
+
+    def install(self, filename, src, content, digest):
+        self.write(filename, content, digest)
+
+    def rename(self, filename, target):
+        # the objects stay, the manifest is rebuilt from the state db
+        if filename in self.paths:
+            self.paths[target] = self.paths.pop(filename)
+
+    def remove(self, filename):
+        # the object is collected by commit() once no manifest refers to it
+        self.paths.pop(filename, None)
+
+    def commit(self, files):
+        self.flush()
+        index = dict(files)
+        self.paths = dict(index)
+        if index == self.index:
+            # nothing changed
+            return
+        keep = set(index.values()) | set(self.index.values())
+        lines = ['# repoview objects manifest\n']
+        for filename in sorted(index):
+            lines.append('%s %s\n' % (index[filename], filename))
+        tmpfile = '%s.tmp' % self.manifest
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            f.write(''.join(lines))
+        os.replace(tmpfile, self.manifest)
+
+        for (dirpath, _, names) in os.walk(self.objdir):
+            for name in names:
+                digest = os.path.basename(dirpath) + name
+                if digest not in keep:
+                    os.unlink(os.path.join(dirpath, name))
+                    self.prune_dirs(dirpath)
+        self.index = index
+        self.pending = set()
+
+SINKS = {
+    'dir':     DirectorySink,
+    'tar':     ArchiveSink,
+    'zip':     ZipSink,
+    'objects': ObjectSink,
+}
+
+class RenderFallback(Exception):
+    """
+    Raised by a compiled template for data it cannot render exactly the
+    way Genshi would; the page is then rendered by Genshi instead.
+    """
+
+class TemplateUnsupported(Exception):
+    """
+    Raised by TemplateCompiler for templates using Genshi features it does
+    not handle; such templates are always rendered by Genshi.
+    """
+
+def _fast_value(value):
+    """
+    Turn the result of a template expression into text, as Genshi does,
+    or raise RenderFallback for values Genshi would splice into the stream
+    as markup or as a sequence of events.
+    """
+    if type(value) is str:
+        return value
+    if isinstance(value, str) or hasattr(value, '__iter__'):
+        raise RenderFallback(type(value).__name__)
+    return str(value)
+
+def _fast_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def _fast_attr(text):
+    return _fast_escape(text).replace('"', '&#34;')
+
+_TRIM_SPACE  = re.compile('[ \t]+(?=\n)').sub
+_COLLAPSE_NL = re.compile('\n{2,}').sub
+
+def _fast_strip(text):
+    return _COLLAPSE_NL('\n', _TRIM_SPACE('', text))
+
+# what compiled templates see as globals, besides the builtins
+_FAST_HELPERS = {
+    'RenderFallback': RenderFallback,
+    '_fast_value':    _fast_value,
+    '_fast_escape':   _fast_escape,
+    '_fast_attr':     _fast_attr,
+    '_fast_strip':    _fast_strip,
+}
+
+class TemplateCompiler:
+    """
+    Translate a Genshi markup template into a Python function that builds
+    the page with string operations, producing the same XHTML as
+    Genshi's xhtml serializer with the xhtml-strict doctype and white
+    space stripping. Only the subset of Genshi used by the shipped
+    templates is handled: ${} and $name substitutions, <?python?> blocks
+    at the top level and the py:for, py:if, py:content, py:replace and
+    (unconditional) py:strip attributes. Anything else raises
+    TemplateUnsupported.
+
+    Expressions are compiled as plain Python, so the data handed to the
+    generated function must be accessed the way Python would (no dotted
+    access to dict keys, no undefined names); otherwise the generated
+    code raises and the page goes to Genshi.
+    """
+
+    # bump when the generated code changes, to invalidate the disk cache
+    VERSION = 1
+
+    PY_NS     = 'http://genshi.edgewall.org/'
+    DOCTYPE   = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+                 '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n')
+    EMPTY     = frozenset(['area', 'base', 'basefont', 'br', 'col', 'frame',
+                           'hr', 'img', 'input', 'isindex', 'link', 'meta',
+                           'param'])
+    BOOLEAN   = frozenset(['selected', 'checked', 'compact', 'declare',
+                           'defer', 'disabled', 'ismap', 'multiple',
+                           'nohref', 'noresize', 'noshade', 'nowrap',
+                           'autofocus', 'readonly', 'required',
+                           'formnovalidate'])
+    PRESERVE  = frozenset(['pre', 'textarea'])
+    DIRECTIVE = frozenset(['for', 'if', 'content', 'replace', 'strip'])
+
+    def __init__(self, filepath):
+        """
+        @param filepath: the template to compile
+        @type  filepath: str
+        """
+        self.filepath = filepath
+        self.lines    = []
+        self.indent   = 1
+        self.preserve = 0
+        # markup not yet emitted, and static text known to be the only
+        # thing in the text buffer (None if unknown at this point)
+        self.markup   = ''
+        self.pending  = ''
+        # names loaded by expressions, with the loop variables in scope
+        self.uses     = []
+        self.stored   = set()
+        self.targets  = set()
+        self.loops    = []
+
+    def compile(self):
+        """
+        Parse the template and generate the source of the module holding
+        its render(data) function.
+
+        @rtype: str
+        """
+        _require('genshi', 'genshi')
+        from genshi.core import START, END, TEXT, COMMENT, PI, DOCTYPE
+        from genshi.core import XML_DECL, START_NS, END_NS
+        from genshi.input import XMLParser
+        from genshi.template.interpolation import interpolate
+
+        with open(self.filepath, 'rb') as fh:
+            events = list(XMLParser(fh, filename=self.filepath,
+                                    encoding='utf-8'))
+
+        def subst(text, pos):
+            parts = []
+            for kind, data, _ in interpolate(text, self.filepath, pos[1],
+                                             pos[2]):
+                if kind is TEXT:
+                    parts.append(('text', data))
+                else:
+                    parts.append(('expr', data.source))
+            return parts
+
+        # build a tree of the template: elements are lists of
+        # ['elem', tag, attrs, directives, children]
+        root = ['elem', None, [], {}, []]
+        stack = [root]
+        for kind, data, pos in events:
+            children = stack[-1][4]
+            if kind is START:
+                tag, attrs = data
+                if tag.namespace:
+                    raise TemplateUnsupported('element %s' % tag)
+                directives = {}
+                plain = []
+                for name, value in attrs:
+                    if name.namespace == self.PY_NS:
+                        if (name.localname not in self.DIRECTIVE or
+                                '$' in value):
+                            raise TemplateUnsupported('py:%s' % name.localname)
+                        directives[name.localname] = value
+                    elif name.namespace or name == 'xml:lang':
+                        raise TemplateUnsupported('attribute %s' % name)
+                    elif value:
+                        plain.append((str(name), subst(value, pos)))
+                    else:
+                        plain.append((str(name), [('text', value)]))
+                elem = ['elem', str(tag), plain, directives, []]
+                children.append(elem)
+                stack.append(elem)
+            elif kind is END:
+                stack.pop()
+            elif kind is TEXT:
+                if children and children[-1][0] == 'rawtext':
+                    children[-1][1] += data
+                else:
+                    children.append(['rawtext', data, pos])
+            elif kind is COMMENT:
+                if not data.lstrip().startswith('!'):
+                    children.append(['markup', '<!--%s-->' % data])
+            elif kind is PI and data[0] == 'python':
+                if any(elem[3] for elem in stack[1:]):
+                    raise TemplateUnsupported('<?python?> under a directive')
+                children.append(['exec', data[1]])
+            elif kind is START_NS or kind is END_NS:
+                if kind is START_NS and data[1] != self.PY_NS:
+                    raise TemplateUnsupported('namespace %s' % data[1])
+            elif kind is DOCTYPE or kind is XML_DECL:
+                # the xhtml-strict doctype always goes first
+                children.append(['flush'])
+            else:
+                raise TemplateUnsupported('%s event' % kind)
+
+        self.walk(root[4], subst)
+        self.flush()
+        self.emit_markup()
+        return self.module()
+
+    def walk(self, nodes, subst):
+        for node in nodes:
+            if node[0] == 'rawtext':
+                self.add_parts(subst(node[1], node[2]))
+            elif node[0] == 'markup':
+                self.flush()
+                self.markup += node[1]
+            elif node[0] == 'flush':
+                self.flush()
+            elif node[0] == 'exec':
+                self.add_exec(node[1])
+            else:
+                self.add_element(node, subst)
+
+    def add_element(self, node, subst):
+        _, tag, attrs, directives, children = node
+        depth = self.indent
+        if 'for' in directives:
+            target, sep, iterable = directives['for'].partition(' in ')
+            if not sep:
+                raise TemplateUnsupported('py:for="%s"' % directives['for'])
+            names = self.names('%s = None' % target, 'exec', loads=False)
+            self.begin_block()
+            self.line('__it = %s' % self.expr(iterable))
+            self.loops.append(names)
+            self.targets.update(names)
+            self.line('if __it is not None:')
+            self.indent += 1
+            self.line('for %s in __it:' % target.strip())
+            self.indent += 1
+        if 'if' in directives:
+            self.begin_block()
+            self.line('if %s:' % self.expr(directives['if']))
+            self.indent += 1
+
+        if 'replace' in directives:
+            self.add_parts([('expr', directives['replace'])])
+        else:
+            strip = 'strip' in directives
+            if strip and directives['strip'].strip():
+                raise TemplateUnsupported('conditional py:strip')
+            if 'content' in directives:
+                content = [['expr', directives['content']]]
+            else:
+                content = children
+            if not strip and tag in self.EMPTY:
+                if content:
+                    raise TemplateUnsupported('content in <%s/>' % tag)
+                self.start_tag(tag, attrs, ' />')
+            else:
+                if not strip:
+                    self.start_tag(tag, attrs, '>')
+                    if self.preserve or tag in self.PRESERVE:
+                        self.preserve += 1
+                for child in content:
+                    if child[0] == 'expr':
+                        self.add_parts([child])
+                    else:
+                        self.walk([child], subst)
+                if not strip:
+                    self.flush()
+                    self.markup += '</%s>' % tag
+                    if self.preserve:
+                        self.preserve -= 1
+
+        if directives.keys() & {'for', 'if'}:
+            self.begin_block()
+            if self.lines[-1].endswith(':'):
+                self.line('pass')
+            self.indent = depth
+            if 'for' in directives:
+                self.loops.pop()
+
+    def start_tag(self, tag, attrs, close):
+        self.flush()
+        static = True
+        markup = '<' + tag
+        for name, parts in attrs:
+            if all(kind == 'text' for kind, _ in parts):
+                value = ''.join(text for _, text in parts)
+                if name in self.BOOLEAN:
+                    value = name
+                if name != 'xml:space':
+                    markup += ' %s="%s"' % (name, _fast_attr(value))
+                continue
+            if name == 'xml:space':
+                continue
+            if static:
+                self.emit_markup(markup)
+                self.line('__a = []')
+                static = False
+                markup = ''
+            else:
+                self.line('__a.append(%r)' % markup)
+                markup = ''
+            self.line('__v = []')
+            for kind, data in parts:
+                if kind == 'text':
+                    self.line('__v.append(%r)' % data)
+                else:
+                    self.line('__x = %s' % self.expr(data))
+                    self.line('if __x is not None:')
+                    self.line('    __v.append(_fast_value(__x))')
+            self.line('if __v:')
+            if name in self.BOOLEAN:
+                self.line('    __a.append(%r)' % (' %s="%s"' % (name, name)))
+            else:
+                self.line("    __a.append(' %s=\"' + _fast_attr(''.join(__v)) "
+                          "+ '\"')" % name)
+        if static:
+            self.markup += markup + close
+        else:
+            self.line('__a.append(%r)' % (markup + close))
+            self.line("__o(''.join(__a))")
+
+    def add_parts(self, parts):
+        for kind, data in parts:
+            if kind == 'text':
+                text = _fast_escape(data)
+                if self.pending is not None:
+                    self.pending += text
+                else:
+                    self.line('__t(%r)' % text)
+            else:
+                self.unknown_text()
+                self.line('__x = %s' % self.expr(data))
+                self.line('if __x is not None:')
+                self.line('    __t(_fast_escape(_fast_value(__x)))')
+
+    def add_exec(self, source):
+        import textwrap
+        source = textwrap.dedent(source).strip('\n')
+        self.names(source, 'exec')
+        self.unknown_text()
+        for line in source.splitlines():
+            self.line(line)
+
+    def flush(self):
+        # a non-text event: whatever text is buffered goes out
+        if self.pending is None:
+            self.emit_markup()
+            self.line('if __text:')
+            if self.preserve:
+                self.line("    __o(''.join(__text))")
+            else:
+                self.line("    __o(_fast_strip(''.join(__text)))")
+            self.line('    __text.clear()')
+        elif self.preserve:
+            self.markup += self.pending
+        else:
+            self.markup += _fast_strip(self.pending)
+        self.pending = ''
+
+    def unknown_text(self):
+        # runtime code follows: put out the static text collected so far
+        self.emit_markup()
+        if self.pending:
+            self.line('__t(%r)' % self.pending)
+        self.pending = None
+
+    def begin_block(self):
+        self.unknown_text()
+
+    def emit_markup(self, extra=''):
+        markup = self.markup + extra
+        self.markup = ''
+        if markup:
+            self.line('__o(%r)' % markup)
+
+    def line(self, text):
+        self.lines.append('    ' * self.indent + text)
+
+    def expr(self, source):
+        source = source.strip()
+        self.uses.append((self.names(source, 'eval'),
+                          set().union(*self.loops)))
+        return '(%s)' % source
+
+    def names(self, source, mode, loads=True):
+        import ast
+        try:
+            tree = ast.parse(source, self.filepath, mode)
+        except SyntaxError as exc:
+            raise TemplateUnsupported(str(exc)) from exc
+        loaded = set()
+        stored = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    loaded.add(node.id)
+                else:
+                    stored.add(node.id)
+            elif isinstance(node, ast.arg):
+                stored.add(node.arg)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                stored.add(node.name)
+            elif isinstance(node, ast.alias):
+                stored.add((node.asname or node.name).split('.')[0])
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                raise TemplateUnsupported('global statement')
+        if not loads:
+            return stored
+        if mode == 'exec':
+            self.stored |= stored
+            self.uses.append((loaded - stored, set().union(*self.loops)))
+        return loaded - stored
+
+    def module(self):
+        # Genshi restores the outer value of a loop variable after the
+        # loop, Python does not; keep loop variables out of the rest of
+        # the template.
+        for loaded, in_scope in self.uses:
+            if loaded & (self.targets - in_scope):
+                raise TemplateUnsupported('loop variable used outside its loop')
+        if self.stored & self.targets:
+            raise TemplateUnsupported('loop variable shadows a name')
+        loaded = set().union(*[names for names, _ in self.uses])
+        free = loaded - self.stored - self.targets
+        builtin = sorted(name for name in free if hasattr(builtins, name))
+        lines = ['# Generated by repoview %s (template compiler %d) from %s'
+                 % (VERSION, self.VERSION, self.filepath),
+                 'def render(__data):']
+        if builtin:
+            # Genshi looks in the data before the builtins
+            lines.append('    if __data.keys() & %r:' % set(builtin))
+            lines.append('        raise RenderFallback(\'shadowed builtin\')')
+        for name in sorted(free.difference(builtin)):
+            lines.append('    %s = __data[%r]' % (name, name))
+        lines.append('    __out = []')
+        lines.append('    __text = []')
+        lines.append('    __o = __out.append')
+        lines.append('    __t = __text.append')
+        lines.append('    __o(%r)' % self.DOCTYPE)
+        lines.extend(self.lines)
+        lines.append("    return ''.join(__out)")
+        return '\n'.join(lines) + '\n'
+
+class GenshiRenderer:
+    """
+    Render templates with Genshi. The TemplateLoader caches parsed
+    templates, so a renderer is kept for the whole session. Genshi is
+    only imported once the first template is loaded.
+    """
+
+    name = 'genshi'
+
+    def __init__(self, templatedir):
+        """
+        @param templatedir: the directory holding the templates
+        @type  templatedir: str
+        """
+        self.templatedir = templatedir
+        self.loader = None
+
+    def render(self, kid, **data):
+        """
+        Render a template as an XHTML page.
+
+        @param kid: the name of the template
+        @type  kid: str
+        @param data: the variables handed to the template
+
+        @return: the page
+        @rtype:  str
+        """
+        stream = self.load(kid).generate(**data)
+        return stream.render('xhtml', doctype='xhtml-strict')
+
+    def render_xml(self, kid, **data):
+        """
+        Render a template as an XML fragment, e.g. for feed descriptions.
+
+        @param kid: the name of the template
+        @type  kid: str
+        @param data: the variables handed to the template
+
+        @rtype: str
+        """
+        return self.load(kid).generate(**data).render()
+
+    def load(self, kid):
+        """
+        Load a template with Genshi.
+
+        @param kid: the name of the template
+        @type  kid: str
+
+        @rtype: genshi.template.MarkupTemplate
+        """
+        if self.loader is None:
+            template = _require('genshi.template', 'genshi')
+            self.loader = template.TemplateLoader(self.templatedir)
+        return self.loader.load(kid)
+
+class CompiledRenderer(GenshiRenderer):
+    """
+    Render XHTML pages with functions built by TemplateCompiler, falling
+    back to Genshi for templates the compiler does not handle and for
+    pages whose data the compiled code does not handle. The generated
+    code is kept in cachedir, keyed by the template contents, so that
+    later runs do not need to parse the templates at all.
+    """
+
+    name = 'compiled'
+
+    def __init__(self, templatedir, cachedir=None):
+        """
+        @param templatedir: the directory holding the templates
+        @type  templatedir: str
+        @param    cachedir: where to keep the generated code, or None
+        @type     cachedir: str
+        """
+        GenshiRenderer.__init__(self, templatedir)
+        self.cachedir  = cachedir
+        self.functions = {}
+        self.fallbacks = 0
+
+    def get_function(self, kid):
+        """
+        Get the compiled render function for a template.
+
+        @param kid: the name of the template
+        @type  kid: str
+
+        @return: the function, or None if the template is not supported
+        @rtype:  function
+        """
+        if kid in self.functions:
+            return self.functions[kid]
+
+        filepath = os.path.join(self.templatedir, kid)
+        with open(filepath, 'rb') as fh:
+            key = hashlib.sha256(fh.read())
+        key.update(('%s:%d' % (VERSION, TemplateCompiler.VERSION)).encode())
+        cachefile = None
+        source = None
+        if self.cachedir is not None:
+            cachefile = os.path.join(self.cachedir, key.hexdigest() + '.py')
+            try:
+                with open(cachefile, encoding='utf-8') as fh:
+                    source = fh.read()
+            except OSError:
+                pass
+
+        if source is None:
+            try:
+                source = TemplateCompiler(filepath).compile()
+            except TemplateUnsupported:
+                # remember that, too
+                source = ''
+            if cachefile is not None:
+                try:
+                    os.makedirs(self.cachedir, exist_ok=True)
+                    tmpfile = '%s.%d' % (cachefile, os.getpid())
+                    with open(tmpfile, 'w', encoding='utf-8') as fh:
+                        fh.write(source)
+                    os.replace(tmpfile, cachefile)
+                except OSError:
+                    # no cache then, we'll just compile again next time
+                    pass
+
+        function = None
+        if source:
+            namespace = dict(_FAST_HELPERS)
+            exec(compile(source, filepath, 'exec'), namespace)
+            function = namespace['render']
+        self.functions[kid] = function
+        return function
+
+    def render(self, kid, **data):
+        """
+        Render a template as an XHTML page, the same way Genshi would.
+
+        @param kid: the name of the template
+        @type  kid: str
+        @param data: the variables handed to the template
+
+        @return: the page
+        @rtype:  str
+        """
+        function = self.get_function(kid)
+        if function is not None:
+            try:
+                return function(data)
+            except Exception: #IGNORE:W0703
+                # Genshi raises its own errors, if any
+                self.fallbacks += 1
+        return GenshiRenderer.render(self, kid, **data)
+
+def _cache_dir():
+    """
+    Where the compiled templates and the parsed comps are kept:
+    $XDG_CACHE_HOME/repoview, or ~/.cache/repoview.
+
+    @rtype: str
+    """
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'repoview')
+
+class RepoMetadata:
+    """
+    The repository side of a repoview run: the primary and other databases
+    (uncompressed into temporary files if needed) and the comps groups.
+    It is loaded once and can be shared by several Repoview instances, each
+    rendering its own filtered view of the same repository.
+    """
+
+    def __del__(self):
+        self.close()
+
+    def __init__(self, opts, cache=False):
+        """
+        @param  opts: OptionParser's opts (repodir, comps and quiet are used)
+        @type   opts: OptionParser
+        @param cache: keep the changelog entries looked up by get_changelog,
+                      useful when several views query the same packages
+        @type  cache: bool
+        """
+        # list of files to remove at the end of processing
+        self.cleanup = []
+        self.opts    = opts
+
+        self.pconn = None # primary.sqlite
+        self.oconn = None # other.sqlite, opened by get_changelog
+        self.other = None
+        # [name, filename, description, pkgnames] lists from comps.xml, or
+        # None when the repository has no comps
+        self.comps_groups = None
+        # (id, name, description, groupids) and (id, name, description,
+        # groupids, optionids) tuples from comps.xml
+        self.comps_categories   = []
+        self.comps_environments = []
+        # pkgKey -> latest changelog row, if caching
+        self.changelogs = None
+        if cache:
+            self.changelogs = {}
+
+        self.setup_repo()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the databases and remove the temporary uncompressed copies.
+
+        @rtype: void
+        """
+        for conn in (self.pconn, self.oconn):
+            if conn is not None:
+                conn.close()
+        self.pconn = self.oconn = None
+        for entry in self.cleanup:
+            if os.access(entry, os.W_OK):
+                os.unlink(entry)
+        self.cleanup = []
+
+    def get_changelog(self, pkg_key):
+        """
+        Return the latest changelog entry of a package.
+
+        @param pkg_key: the pkgKey of the package in primary.sqlite
+        @type  pkg_key: int
+
+        @return: (author, date, changelog) or None
+        @rtype:  tuple
+        """
+        if self.changelogs is not None and pkg_key in self.changelogs:
+            return self.changelogs[pkg_key]
+
+        if self.oconn is None:
+            self.open_other()
+
+        query = '''SELECT author, date, changelog
+                     FROM changelog WHERE pkgKey=%d
+                 ORDER BY date DESC LIMIT 1''' % pkg_key
+        ocursor = self.oconn.cursor()
+        ocursor.execute(query)
+        orow = ocursor.fetchone()
+        if self.changelogs is not None:
+            self.changelogs[pkg_key] = orow
+        return orow
+
+    def get_changelogs(self, pkg_keys):
+        """
+        Return the complete changelogs of a batch of packages, looked up
+        with a single scan of the changelogs database.
+
+        @param pkg_keys: the pkgKeys of the packages in primary.sqlite
+        @type  pkg_keys: list
+
+        @return: pkgKey -> list of (author, date, changelog), newest first
+        @rtype:  dict
+        """
+        if self.oconn is None:
+            self.open_other()
+
+        query = '''SELECT pkgKey, author, date, changelog
+                     FROM changelog WHERE pkgKey IN (%s)
+                 ORDER BY pkgKey, date DESC, rowid''' % ', '.join(
+                     ['%d' % pkg_key for pkg_key in pkg_keys])
+        ocursor = self.oconn.cursor()
+        ocursor.execute(query)
+        changelogs = {}
+        for (pkg_key, author, date, changelog) in ocursor:
+            changelogs.setdefault(pkg_key, []).append((author, date,
+                                                       changelog))
+        return changelogs
+
+    def setup_repo(self):
+        """
+        Validates the repository structure and initializes database connections.
+        
+        It parses 'repodata/repomd.xml' to locate the 'primary' (packages) and 
+        'other' (changelogs) SQLite databases, as well as the 'group' (comps) file.
+        It also checks for schema version compatibility.
+
+        @rtype: void
+        """
+        self.say('Examining repository...')
+        repomd = os.path.join(self.opts.repodir, 'repodata', 'repomd.xml')
+
+        if not os.access(repomd, os.R_OK):
+            sys.stderr.write('Not found: %s\n' % repomd)
+            sys.stderr.write('Does not look like a repository. Exiting.\n')
+            sys.exit(1)
+
+        repoxml = open(repomd).read()
+
+        xml = fromstring(repoxml) #IGNORE:E1101
+        # look for primary_db, other_db, and optionally group
+
+        primary = other = comps = comps_checksum = dbversion = None
+
+        xmlns = 'http://linux.duke.edu/metadata/repo'
+        for datanode in xml.findall('{%s}data' % xmlns):
+            href = datanode.find('{%s}location' % xmlns).attrib['href']
+            if datanode.attrib['type'] == 'primary_db':
+                primary = os.path.join(self.opts.repodir, href)
+                dbversion = datanode.find('{%s}database_version' % xmlns).text
+            elif datanode.attrib['type'] == 'other_db':
+                other = os.path.join(self.opts.repodir, href)
+            elif datanode.attrib['type'] == 'group':
+                comps = os.path.join(self.opts.repodir, href)
+                comps_checksum = datanode.findtext('{%s}checksum' % xmlns)
+
+        if primary is None or dbversion is None:
+            self.say('Sorry, sqlite files not found in the repository.\n'
+                     'Please rerun createrepo with a -d flag and try again.\n')
+            sys.exit(1)
+
+        if int(dbversion) > SUPPORTED_DB_VERSION:
+            self.say('Sorry, the db_version in the repository is %s, but '
+                     'repoview only supports versions up to %s. Please check '
+                     'for a newer repoview version.\n' % (dbversion,
+                                                          SUPPORTED_DB_VERSION))
+            sys.exit(1)
+
+        self.say('done\n')
+
+        self.say('Opening primary database...')
+        primary = self.z_handler(primary)
+        self.pconn = sqlite.connect(primary)
+        self.say('done\n')
+
+        # other.sqlite is only uncompressed once a changelog is looked up
+        self.other = other
+
+        if self.opts.comps:
+            comps = self.opts.comps
+            comps_checksum = None
+
+        if comps:
+            self.setup_comps_groups(comps, comps_checksum)
+
+    def open_other(self):
+        """
+        Open the changelogs database, uncompressing it first if needed.
+
+        @rtype: void
+        """
+        self.say('Opening changelogs database...')
+        self.oconn = sqlite.connect(self.z_handler(self.other))
+        self.say('done\n')
+
+    def say(self, text):
+        """
+        Unless in quiet mode, output the text passed.
+
+        @param text: something to say
+        @type  text: str
+
+        @rtype: void
+        """
+        if not self.opts.quiet:
+            sys.stdout.write(text)
+
+    def z_handler(self, dbfile):
+        """
+        If the database file is compressed, uncompresses it and returns the
+        filename of the uncompressed file.
+
+        @param dbfile: the name of the file
+        @type  dbfile: str
+
+        @return: the name of the uncompressed file
+        @rtype:  str
+        """
+        (junk, ext) = os.path.splitext(dbfile)
+
+        if ext == '.bz2':
+            from bz2 import BZ2File
+            zfd = BZ2File(dbfile)
+        elif ext == '.gz':
+            from gzip import GzipFile
+            zfd = GzipFile(dbfile)
+        elif ext == '.xz':
+            from lzma import LZMAFile
+            zfd = LZMAFile(dbfile)
+        else:
+            # not compressed (or something odd)
+            return dbfile
+
+        import tempfile
+        (unzfd, unzname) = tempfile.mkstemp('.repoview')
+        self.cleanup.append(unzname)
+
+        unzfd = open(unzname, 'wb')
+
+        while True:
+            data = zfd.read(16384)
+            if not data:
+                break
+            unzfd.write(data)
+        zfd.close()
+        unzfd.close()
+
+        return unzname
+
+    def setup_comps_groups(self, compsxml, checksum=None):
+        """
+        Read the groups, categories and environments from comps.xml, with
+        libcomps if available, else with _parse_comps. What is read is
+        cached in _cache_dir(), one COMPSCACHE file per repository,
+        keyed by the checksum of comps.xml, so that it is only parsed again
+        once it changed. The output and state directories are no place for
+        it: the former does not exist before the first run and both are
+        wiped by --force.
+
+        @param compsxml: the location of comps.xml
+        @type  compsxml: str
+        @param checksum: the checksum of comps.xml from repomd.xml, if any;
+                         the sha256 of the file is used otherwise
+        @type  checksum: str
+
+        @rtype: void
+        """
+        self.say('Parsing comps.xml...')
+        if checksum is None:
+            with open(compsxml, 'rb') as fh:
+                checksum = hashlib.sha256(fh.read()).hexdigest()
+        key = '%s:%s' % (VERSION, checksum)
+
+        # per repository: comps filenames often carry their checksum
+        location = os.path.abspath(self.opts.repodir)
+        location = hashlib.md5(location.encode()).hexdigest()
+        cachedir = _cache_dir()
+        cachefile = os.path.join(cachedir, '%s.%s' % (location, COMPSCACHE))
+        comps = None
+        try:
+            with open(cachefile, encoding='utf-8') as fh:
+                cached = json.load(fh)
+            if cached.get('key') == key:
+                comps = cached
+        except (OSError, ValueError):
+            pass
+
+        if comps is not None:
+            self.say('cached...')
+        else:
+            try:
+                comps = _libcomps_parse(compsxml)
+            except ImportError:
+                comps = _parse_comps(compsxml)
+            comps['key'] = key
+            try:
+                os.makedirs(cachedir, exist_ok=True)
+                tmpfile = '%s.%d' % (cachefile, os.getpid())
+                with open(tmpfile, 'w', encoding='utf-8') as fh:
+                    json.dump(comps, fh)
+                os.replace(tmpfile, cachefile)
+            except OSError:
+                # e.g. a read-only home, parse again next time
+                pass
+
+        self.comps_groups = []
+        for (group_id, name, description, pkg_names) in comps['groups']:
+            if not pkg_names:
+                continue
+            group_filename = _mkid(GRPFILE % group_id)
+            self.comps_groups.append([name, group_filename, description,
+                                      list(pkg_names)])
+        self.comps_categories = [tuple(category)
+                                 for category in comps['categories']]
+        self.comps_environments = [tuple(environment)
+                                   for environment in comps['environments']]
+        self.say('done\n')
+
+
+class Repoview:
+    """
+    A build session for one view of a repository.
+    
+    The workflow is split into phases, run in order by run():
+    1. load: initializing repository connections and state database,
+    2. plan: working out the groups and packages to process,
+    3. render: rendering templates using Genshi, managing incremental
+       builds via checksums, and generating the HTML output and RSS feeds,
+    4. finalize: removing stale files and committing the state.
+    Between plan() and close(), single packages or groups can be regenerated
+    with render_package() and render_group(), reusing the loaded metadata and
+    compiled templates. Use it as a context manager to release resources.
+    """
+
+    def __init__(self, opts, metadata=None):
+        """
+        Set up a build session. Nothing is read or written until the phases
+        are run, either all at once with run() or one by one with load(),
+        plan(), render() and finalize().
+
+        @param     opts: OptionParser's opts, as set up by main() or
+                         default_options()
+        @type      opts: OptionParser
+        @param metadata: already loaded repository metadata to render from,
+                         loaded from opts.repodir if not given (and then
+                         released by close())
+        @type  metadata: RepoMetadata
+        """
+        self.opts     = opts
+        self.metadata = metadata
+        self.own_metadata = metadata is None
+        # Honor the CLI-provided output directory name (defaults to "repoview")
+        # but always treat it as a subdirectory of the repository root.
+        self.outdir  = os.path.join(opts.repodir, opts.outdir)
+
+        self.exclude    = '1=1'
+        # Dictionary storing filename -> checksum mapping from the state database (previous run).
+        # Used to determine if a file needs to be regenerated.
+        self.state_data = {} 
+        # Dictionary storing filename -> checksum for the files visited during
+        # this session, so pages can be regenerated more than once.
+        self.visited    = {}
+        # Dictionary tracking packages processed in the current run to handle duplicates
+        # and avoid re-processing. Maps pkgname -> pkg_tuple.
+        self.written    = {} 
+        # Dictionary of filename -> sha256 of the bytes last written (or found
+        # on disk when recovering), so identical pages are never rewritten.
+        self.digests    = {}
+        # Files written and removed during this run, for the manifest delta.
+        self.changed    = []
+        self.removed    = []
+        # Run counter, stored in the meta table of the state db and never
+        # lower than the one published in MANIFEST (see load).
+        self.generation = 1
+        # Relative path from a package page back to the output directory,
+        # handed to package.kid as "root" for layout and group links.
+        self.pkg_root   = ''
+        if opts.hashdirs:
+            self.pkg_root = '../../'
+
+        self.groups        = []
+        self.letter_groups = []
+        # (name, filename, description) of the category and environment
+        # pages, see render_comps_pages
+        self.categories    = []
+        self.environments  = []
+        # repo_data dict handed to every template, set up by plan()
+        self.repo_data     = None
+        # (group_data, pkgnames) for every group to render, set up by plan()
+        self.group_plan    = []
+        # whether render() went through the whole site in this session
+        self.rendered      = False
+
+        self.pconn = None # primary.sqlite
+        self.sconn = None # state db
+        # the pkg_data fields the templates use, set up by setup_repo()
+        self.fields = ALL_FIELDS
+        # sha256 of rss.kid, part of the feed entry identity
+        self.rss_digest = None
+        # (filename, pkgKeys) of the changelog fragments waiting for
+        # write_histories
+        self.histories  = []
+        # what recover_state may adopt, set up by is_site_file
+        self.site_files = None
+
+        # where the pages go, see SINKS
+        self.sink = SINKS[opts.sink](self.outdir, opts.writers)
+
+        # Renders the pages (see --renderer); it caches the loaded templates,
+        # so it is kept for the whole session.
+        self.renderer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Release the state db and, if we loaded it ourselves, the repository
+        metadata. Anything not committed by finalize() is discarded.
+
+        @rtype: void
+        """
+        self.sink.close()
+        if self.sconn is not None:
+            self.sconn.close()
+            self.sconn = None
+        if self.own_metadata and self.metadata is not None:
+            self.metadata.close()
+            self.metadata = None
+
+    def run(self):
+        """
+        Run all the phases of a repoview build.
+
+        @rtype: void
+        """
+        self.load()
+        self.plan()
+        self.render()
+        self.finalize()
+
+    def load(self):
+        """
+        Phase 1 and 2: locate repository metadata, initialize database
+        handles, prepare the output directory and the incremental build state.
+
+        @rtype: void
+        """
+        self.setup_repo()
+        # before --force wipes the output directory
+        self.generation = self.manifest_generation() + 1
+        self.setup_outdir()
+        self.setup_state_db()
+        self.migrate_layout()
+        self.sync_layout()
+        self.setup_excludes()
+
+        if self.opts.renderer == 'genshi':
+            self.renderer = GenshiRenderer(self.opts.templatedir)
+        else:
+            self.renderer = CompiledRenderer(self.opts.templatedir,
+                                             _cache_dir())
+
+    def plan(self):
+        """
+        Work out the groups to render: comps groups (or RPM groups if there
+        are none) plus the alphabetical "Letter" buckets.
+
+        @rtype: void
+        """
+        if not self.groups:
+            self.setup_rpm_groups()
+
+        letters = self.setup_letter_groups()
+
+        self.repo_data = {
+                          'title':      self.opts.title,
+                          'letters':    letters,
+                          'my_version': VERSION
+                         }
+
+        self.group_plan = []
+        for (grp_name, grp_filename, grp_description, pkgnames) in \
+                self.groups + self.letter_groups:
+            pkgnames.sort()
+            group_data = {
+                          'name':        grp_name,
+                          'description': grp_description,
+                          'filename':    grp_filename,
+                          }
+            self.group_plan.append((group_data, pkgnames))
+
+    def render(self):
+        """
+        Phase 3 and 4: render the package and group pages, then the index
+        and the RSS feed. Only pages whose checksum changed are written.
+
+        @rtype: void
+        """
+        count = 0
+        # Iterate through all logical groups (explicit comps groups plus
+        # auto-generated alphabetical "Letter" buckets).  Each iteration renders
+        # the packages belonging to the group, wires them into group metadata, and
+        # produces the HTML if any of the constituent checksums changed.
+        for (group_data, pkgnames) in self.group_plan:
+            # Package pages double as a cache warm-up for group pages: the call returns
+            # summary tuples used on the group listing while also writing/refining the
+            # individual package HTML files.
+            packages = self.do_packages(self.repo_data, group_data, pkgnames)
+
+            if not packages:
+                # Empty groups are ignored
+                del self.groups[count]
+                continue
+
+            count += 1
+
+            for page_data in self.paginate_group(group_data, packages):
+                self.do_group(self.repo_data, page_data)
+
+        self.write_histories()
+        if self.opts.compspages:
+            self.render_comps_pages()
+        self.render_index()
+        self.rendered = True
+
+    def render_index(self):
+        """
+        Build the aggregated views: latest packages list, index page and,
+        if a URL was given, the feeds.
+
+        @rtype: void
+        """
+        # a copy, so that pages regenerated later in the session get the
+        # same repo_data, and thus the same checksums, as in a full run
+        repo_data = dict(self.repo_data)
+        latest = self.get_latest_packages(max(LATEST, self.opts.feedlength))
+        repo_data['latest'] = latest[:LATEST]
+        repo_data['groups'] = self.groups
+
+        checksum = self.mk_checksum(repo_data,
+                                    {'categories':   self.categories,
+                                     'environments': self.environments})
+        if self.has_changed(IDXFILE, checksum):
+            # Write index.html
+            self.say('Writing index.html...')
+            self.write_file(IDXFILE,
+                            self.renderer.render(IDXKID, repo_data=repo_data,
+                                                 url=self.opts.url,
+                                                 groups=self.groups,
+                                                 categories=self.categories,
+                                                 environments=self.environments,
+                                                 latest=latest[:LATEST]))
+            self.say('done\n')
+
+        # feeds need absolute links; they go away as stale files once --url
+        # is dropped
+        if self.opts.url:
+            self.render_feeds(repo_data, latest)
+
+    def render_comps_pages(self):
+        """
+        Write a page for every comps category and environment, listing its
+        groups the way a group page lists packages, with group.kid. Groups
+        that were not rendered, e.g. because they are empty in this view,
+        are left out, and so are categories and environments left with no
+        groups at all. The pages written are listed in self.categories and
+        self.environments, for the index.
+
+        @rtype: void
+        """
+        rendered = {}
+        for (name, filename, description, _) in self.groups:
+            rendered[filename] = (name, filename, description)
+
+        def members(group_ids, suffix=''):
+            found = []
+            for group_id in group_ids:
+                group = rendered.get(_mkid(GRPFILE % group_id))
+                if group is not None:
+                    found.append((group[0] + suffix, group[1], group[2]))
+            return found
+
+        self.categories = []
+        self.environments = []
+        pages = []
+        for (cat_id, name, description, group_ids) in \
+                self.metadata.comps_categories:
+            pages.append((self.categories, _mkid(CATFILE % cat_id), name,
+                          description, members(group_ids)))
+        for (env_id, name, description, group_ids, option_ids) in \
+                self.metadata.comps_environments:
+            pages.append((self.environments, _mkid(ENVFILE % env_id), name,
+                          description,
+                          members(group_ids) + members(option_ids,
+                                                       ' (optional)')))
+
+        for (listing, filename, name, description, groups) in pages:
+            if not groups:
+                continue
+            page_data = {
+                         'name':        name,
+                         'description': description,
+                         'filename':    filename,
+                         'packages':    groups,
+                         'prev_page':   None,
+                         'next_page':   None,
+                         'page_label':  None,
+                        }
+            self.do_group(self.repo_data, page_data)
+            listing.append((name, filename, description))
+
+    def render_package(self, pkgname):
+        """
+        Regenerate a single package page, e.g. from tooling that keeps the
+        session around. The page is written only if it changed.
+
+        @param pkgname: the name of the package
+        @type  pkgname: str
+
+        @return: the (pkg_name, pkg_filename, pkg_summary) tuple, or None if
+                 the package is not part of this view
+        @rtype:  tuple
+        """
+        for (group_data, pkgnames) in self.group_plan:
+            if pkgname in pkgnames:
+                self.written.pop(pkgname, None)
+                packages = self.do_packages(self.repo_data, group_data,
+                                            [pkgname])
+                self.write_histories()
+                if packages:
+                    return packages[0]
+                return None
+        return None
+
+    def render_group(self, name):
+        """
+        Regenerate the pages of a single group, and of its packages, if they
+        changed.
+
+        @param name: the group name or filename, e.g. "Letter A" or
+                     "letter_a.group.html"
+        @type  name: str
+
+        @return: True if the group was found and is not empty
+        @rtype:  bool
+        """
+        for (group_data, pkgnames) in self.group_plan:
+            if name not in (group_data['name'], group_data['filename']):
+                continue
+            # a package page shows the first group the package is in, as
+            # in a full run, which is not necessarily this one
+            homes = {}
+            for pkgname in pkgnames:
+                self.written.pop(pkgname, None)
+                for (index, (_, home_pkgnames)) in enumerate(self.group_plan):
+                    if pkgname in home_pkgnames:
+                        homes.setdefault(index, []).append(pkgname)
+                        break
+            for index in sorted(homes):
+                self.do_packages(self.repo_data, self.group_plan[index][0],
+                                 homes[index])
+            self.write_histories()
+            # all in self.written now
+            packages = self.do_packages(self.repo_data, group_data, pkgnames)
+            if not packages:
+                return False
+            for page_data in self.paginate_group(group_data, packages):
+                self.do_group(self.repo_data, page_data)
+            return True
+        return False
+
+    def finalize(self):
+        """
+        Phase 5: delete orphaned files (only if render() ran, as only then
+        are all pages visited), commit the output sink and persist state so
+        the next run can stay incremental, then publish the manifest if
+        asked. The session can keep regenerating pages afterwards and be
+        finalized again.
+
+        @rtype: void
+        """
+        # every page must be on disk before stale files go and state is saved
+        self.sink.flush()
+        # only a full render() visits every page; after regenerating single
+        # pages, whatever was not visited is still part of the site
+        if self.rendered:
+            self.remove_stale()
+        if self.opts.manifest:
+            self.fill_digests()
+        scursor = self.sconn.cursor()
+        if self.changed or self.removed:
+            scursor.execute("""INSERT OR REPLACE INTO meta (key, value)
+                                   VALUES ('generation', '%d')""" % self.generation)
+        # publish before saving the state, so that the state db never claims
+        # more than what is out there
+        scursor.execute("""SELECT filename, digest
+                             FROM state
+                            WHERE digest IS NOT NULL""")
+        self.sink.commit(scursor.fetchall())
+        self.sconn.commit()
+        if self.opts.manifest:
+            self.write_manifest()
+
+        if self.changed or self.removed:
+            self.generation += 1
+        self.changed = []
+        self.removed = []
+
+    def setup_repo(self):
+        """
+        Find out which package fields the templates need, load the
+        repository metadata, unless it was handed to us, and take our own
+        copy of the comps groups, which get sorted and pruned while
+        rendering.
+
+        @rtype: void
+        """
+        kids = [PKGKID]
+        if self.opts.url:
+            kids.append(RSSKID)
+        self.fields = _template_fields(self.opts.templatedir, kids)
+
+        if self.metadata is None:
+            self.metadata = RepoMetadata(self.opts)
+        self.pconn = self.metadata.pconn
+        if self.metadata.comps_groups:
+            for (name, filename, description, pkgnames) in self.metadata.comps_groups:
+                self.groups.append([name, filename, description, list(pkgnames)])
+
+    def setup_state_db(self):
+        """
+        Initializes the SQLite database used for incremental build state tracking.
+        
+        The database stores checksums of previously generated files to avoid 
+        unnecessary writes. If a specific state directory is not provided, 
+        it creates 'state.sqlite' in the output directory.
+
+        @rtype: void
+        """
+        self.say('Examining state db...')
+        statedb = _state_file(self.opts, 'state.sqlite')
+
+        recover = False
+        if os.access(statedb, os.W_OK) and self.sink.lost():
+            self.say('output is gone...')
+            self.opts.force = True
+        if os.access(statedb, os.W_OK):
+            if self.opts.force:
+                # clean slate -- remove state db and start over
+                os.unlink(statedb)
+        elif self.opts.recover and not self.opts.force:
+            # state_db not found, but we can rebuild it from the output dir
+            recover = True
+        else:
+            # state_db not found, go into force mode
+            self.opts.force = True
+
+        self.sconn = sqlite.connect(statedb)
+        scursor = self.sconn.cursor()
+
+        query = """CREATE TABLE IF NOT EXISTS state (
+                          filename TEXT UNIQUE,
+                          checksum TEXT,
+                          size INTEGER,
+                          digest TEXT,
+                          generation INTEGER)"""
+        scursor.execute(query)
+
+        # state dbs from older versions only have filename and checksum
+        scursor.execute("""PRAGMA table_info(state)""")
+        columns = [row[1] for row in scursor.fetchall()]
+        for (column, coltype) in (('size', 'INTEGER'), ('digest', 'TEXT'),
+                                  ('generation', 'INTEGER')):
+            if column not in columns:
+                scursor.execute("""ALTER TABLE state
+                                    ADD COLUMN %s %s""" % (column, coltype))
+
+        query = """CREATE TABLE IF NOT EXISTS meta (
+                          key TEXT UNIQUE,
+                          value TEXT)"""
+        scursor.execute(query)
+        # rendered feed entries, see get_feed_items
+        query = """CREATE TABLE IF NOT EXISTS feed_items (
+                          ident TEXT UNIQUE,
+                          guid TEXT,
+                          link TEXT,
+                          title TEXT,
+                          summary TEXT,
+                          built INTEGER,
+                          description TEXT)"""
+        scursor.execute(query)
+        scursor.execute("""SELECT value FROM meta WHERE key='generation'""")
+        row = scursor.fetchone()
+        if row is not None:
+            self.generation = max(self.generation, int(row[0]) + 1)
+
+        if recover:
+            self.recover_state()
+
+        # read all state data into memory to track orphaned files
+        query = """SELECT filename, checksum, digest FROM state"""
+        scursor.execute(query)
+        while True:
+            row = scursor.fetchone()
+            if row is None:
+                break
+            self.state_data[row[0]] = row[1]
+            if row[2] is not None:
+                self.digests[row[0]] = row[2]
+        self.say('done\n')
+
+    def recover_state(self):
+        """
+        Rebuild the state db from the pages already present in the output
+        directory. Every page found is registered with an empty checksum and
+        the digest of its bytes, so it is rendered again and compared against
+        what is on disk (see write_file); identical pages are adopted without
+        being rewritten, and pages that are no longer generated are removed
+        as stale. Only files repoview could have written for this repository
+        are adopted (see is_site_file); anything else in the output
+        directory is left alone.
+
+        @rtype: void
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        self.say('Recovering state from %s...' % self.outdir)
+        filenames = [filename for filename in self.sink.list()
+                     if self.is_site_file(filename)]
 
-        self.say('Opening changelogs database...')
-        other = self.z_handler(other)
-        self.oconn = sqlite.connect(other)
-        self.say('done\n')
+        with ThreadPoolExecutor() as pool:
+            stats = list(pool.map(self.file_digest, filenames))
 
-        if self.opts.comps:
-            comps = self.opts.comps
+        scursor = self.sconn.cursor()
+        for (filename, (size, digest)) in zip(filenames, stats):
+            # it is unknown when they last changed, like in fill_digests
+            query = """INSERT INTO state (filename, checksum, size, digest,
+                                           generation)
+                                VALUES ('%s', '', %d, '%s', 0)""" % (filename,
+                                                                    size, digest)
+            scursor.execute(query)
+        self.say('found %d pages\n' % len(filenames))
 
-        if comps:
-            self.setup_comps_groups(comps)
+    def is_site_file(self, filename):
+        """
+        Tell whether a file in the output directory is one repoview could
+        have written for this repository: a package page or changelog
+        fragment of a package in primary (flat, or in its PKGDIR/xx/
+        shard), a group, letter, category or environment page, the index or
+        a feed. Pages of another view nested in the output directory, or
+        files put there by hand, are not.
+
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+
+        @rtype: bool
+        """
+        if self.site_files is None:
+            pkgids = set()
+            groups = set(group[1] for group in self.groups)
+            pcursor = self.pconn.cursor()
+            pcursor.execute("""SELECT DISTINCT name, lower(rpm_group)
+                                 FROM packages""")
+            for (pkgname, rpmgroup) in pcursor.fetchall():
+                pkgids.add(_mkid(pkgname))
+                # see setup_rpm_groups and setup_letter_groups
+                groups.add(_mkid(GRPFILE % rpmgroup))
+                groups.add(_mkid(GRPFILE % ('Letter %s'
+                                            % pkgname[:1].upper())).lower())
+            pages = set(groups)
+            pages.add(IDXFILE)
+            pages.update(FEEDFILES.values())
+            for category in self.metadata.comps_categories:
+                pages.add(_mkid(CATFILE % category[0]))
+            for environment in self.metadata.comps_environments:
+                pages.add(_mkid(ENVFILE % environment[0]))
+            grp_bases = set(group[:-len(GRPFILE % '')] for group in groups)
+            self.site_files = (pkgids, pages, grp_bases)
+        (pkgids, pages, grp_bases) = self.site_files
+
+        if filename in pages:
+            return True
+        (dirname, flat) = os.path.split(filename)
+        for suffix in (HISTFILE % '', PKGFILE % ''):
+            if flat.endswith(suffix) and flat[:-len(suffix)] in pkgids:
+                page = flat[:-len(suffix)] + PKGFILE % ''
+                shard = hashlib.md5(page.encode()).hexdigest()[:2]
+                return dirname in ('', '%s/%s' % (PKGDIR, shard))
+        if dirname or not flat.endswith(GRPFILE % ''):
+            return False
+        # further pages of a paginated group (see paginate_group); package
+        # names may contain "+", so try every split
+        name = flat[:-len(GRPFILE % '')]
+        for (index, char) in enumerate(name):
+            if (char == '+' and name[:index] in grp_bases
+                    and name[index+1:] in pkgids):
+                return True
+        return False
 
     def say(self, text):
         """
@@ -433,8 +2529,8 @@ class Repoview:
         """
         Prepares the output directory for generating the static site.
         
-        It handles cleaning up if force mode is active, ensures correct permissions (755),
-        and copies static layout assets (CSS, images) from the template directory.
+        It handles cleaning up if force mode is active and ensures correct
+        permissions (755). Layout assets are handled later by sync_layout.
 
         @rtype: void
         """
@@ -446,13 +2542,129 @@ class Repoview:
         os.makedirs(self.outdir, exist_ok=True)
         os.chmod(self.outdir, 0o755)
 
-        # Copy the layout from template if it exists and destination does not exist
+    def sync_layout(self):
+        """
+        Bring the "layout" directory (CSS, images) in the output directory in
+        line with the one in the template directory. Each asset is tracked in
+        the state db by the sha256 of its contents, so only new or modified
+        assets are installed (see _install_file), and assets removed from the
+        template are cleaned up as stale files.
+
+        @rtype: void
+        """
         layoutsrc = os.path.join(self.opts.templatedir, 'layout')
-        layoutdst = os.path.join(self.outdir, 'layout')
-        if os.path.isdir(layoutsrc) and not os.path.exists(layoutdst):
-            self.say('Copying layout...')
-            shutil.copytree(layoutsrc, layoutdst)
-            self.say('done\n')
+        if not os.path.isdir(layoutsrc):
+            return
+
+        self.say('Syncing layout...')
+        count = 0
+        for (dirpath, dirnames, files) in os.walk(layoutsrc):
+            dirnames.sort()
+            for name in sorted(files):
+                src = os.path.join(dirpath, name)
+                relpath = os.path.relpath(src, self.opts.templatedir)
+                filename = relpath.replace(os.sep, '/')
+                with open(src, 'rb') as f:
+                    content = f.read()
+                digest = hashlib.sha256(content).hexdigest()
+
+                exists = self.sink.exists(filename, digest)
+                if not self.has_changed(filename, digest) and exists:
+                    continue
+                if exists and self.file_digest(filename)[1] == digest:
+                    # already there, only the state db needs to learn about it
+                    self.record_file(filename, len(content), digest,
+                                     changed=False)
+                    continue
+
+                self.sink.install(filename, src, content, digest)
+                self.record_file(filename, len(content), digest)
+                count += 1
+        self.say('%d updated\n' % count)
+
+    def pkg_filename(self, pkgname, flat=None):
+        """
+        Return the path of a package page, relative to the output directory.
+        With --hashed-dirs, pages are spread over PKGDIR/xx/ subdirectories,
+        xx being the first two hex digits of the md5 of the flat filename.
+
+        @param pkgname: the name of the package
+        @type  pkgname: str
+        @param    flat: the flat page filename, if already known (pkgname is
+                        then ignored)
+        @type     flat: str
+
+        @return: the page path, using "/" as separator
+        @rtype:  str
+        """
+        if flat is None:
+            flat = _mkid(PKGFILE % pkgname)
+        if not self.opts.hashdirs:
+            return flat
+        shard = hashlib.md5(flat.encode()).hexdigest()[:2]
+        return '%s/%s/%s' % (PKGDIR, shard, flat)
+
+    def migrate_layout(self):
+        """
+        Move package pages and their changelog fragments left by a previous
+        run with the other output layout (flat or --hashed-dirs) to where
+        this run expects them, and rename their state db entries
+        accordingly. The checksums of the pages are reset, since the
+        relative links inside a page depend on its depth; fragments do not
+        link anywhere and keep theirs. Moved files count as written in this
+        generation, so that the manifest delta lists them under their new
+        path. Stale detection keeps working on the new paths.
+
+        Only pages at the top of the output directory or in a PKGDIR/xx/
+        shard are moved; anything else is left to stale detection.
+
+        @rtype: void
+        """
+        moves = []
+        for filename in self.state_data:
+            (dirname, flat) = os.path.split(filename)
+            if dirname and not re.match('^%s/[0-9a-f]{2}$' % PKGDIR, dirname):
+                continue
+            if filename.endswith(HISTFILE % ''):
+                # next to the page of the same package
+                page = self.pkg_filename(None, flat=flat[:-len(HISTFILE % '')]
+                                                    + PKGFILE % '')
+                target = os.path.dirname(page)
+                if target:
+                    target += '/'
+                target += flat
+                checksum = self.state_data[filename]
+            elif (filename.endswith(GRPFILE % '') or filename == IDXFILE
+                    or filename.endswith(CATFILE % '')
+                    or filename.endswith(ENVFILE % '')
+                    or not filename.endswith(PKGFILE % '')):
+                continue
+            else:
+                target = self.pkg_filename(None, flat=flat)
+                checksum = ''
+            if target != filename and target not in self.state_data:
+                moves.append((filename, target, checksum))
+        if not moves:
+            return
+
+        self.say('Moving %d package pages and changelogs to the new '
+                 'layout...' % len(moves))
+        scursor = self.sconn.cursor()
+        for (filename, target, checksum) in moves:
+            if filename in self.digests:
+                self.digests[target] = self.digests[filename]
+            self.sink.rename(filename, target)
+            query = """UPDATE state
+                          SET filename='%s', checksum='%s', generation=%d
+                        WHERE filename='%s'""" % (target, checksum,
+                                                   self.generation, filename)
+            scursor.execute(query)
+            del self.state_data[filename]
+            self.state_data[target] = checksum
+            self.digests.pop(filename, None)
+            self.removed.append(filename)
+            self.changed.append(target)
+        self.say('done\n')
 
     def get_package_data(self, pkgname):
         """
@@ -471,6 +2683,7 @@ class Repoview:
                     'rpm_license':   str,
                     'rpm_sourcerpm': str,
                     'vendor':        str,
+                    'history':       str, # see history_filename
                     'rpms':          [] # List of version tuples
                     }
 
@@ -478,30 +2691,33 @@ class Repoview:
             (epoch, version, release, arch, time_build, size, location_href,
              author, changelog, time_added)
 
+        Fields the templates do not use (see _template_fields) are None, and
+        the columns and changelogs behind them are not queried.
+
         @param pkgname: the name of the package to look up
         @type  pkgname: str
 
         @return: A dictionary containing the package details and version history.
         @rtype:  dict
         """
-        # fetch versions
+        # fetch versions, leaving out the columns nobody looks at
+        columns = []
+        for (field, column) in list(PKG_FIELDS.items()) + list(RPM_COLUMNS.items()):
+            if field not in self.fields:
+                column = 'NULL'
+            columns.append(column)
         query = """SELECT pkgKey,
                           epoch,
                           version,
                           release,
                           arch,
                           summary,
-                          description,
-                          url,
                           time_build,
-                          rpm_license,
-                          rpm_sourcerpm,
-                          size_package,
-                          location_href,
-                          rpm_vendor
+                          %s
                      FROM packages
                     WHERE name='%s' AND %s
-                 ORDER BY arch ASC""" % (pkgname, self.exclude)
+                 ORDER BY arch ASC""" % (', '.join(columns), pkgname,
+                                           self.exclude)
         pcursor = self.pconn.cursor()
         pcursor.execute(query)
 
@@ -528,7 +2744,7 @@ class Repoview:
             keys.sort(key=functools.cmp_to_key(_compare_evra), reverse=True)
             versions = [temp[key] for key in keys]
 
-        pkg_filename = _mkid(PKGFILE % pkgname)
+        pkg_filename = self.pkg_filename(pkgname)
 
         pkg_data = {
                     'name':          pkgname,
@@ -539,16 +2755,20 @@ class Repoview:
                     'rpm_license':   None,
                     'rpm_sourcerpm': None,
                     'vendor':        None,
+                    'history':       None,
                     'rpms':          []
                     }
+        if self.opts.history:
+            # relative to the package page
+            pkg_data['history'] = os.path.basename(self.history_filename(pkgname))
 
         # Build a human-readable payload for the template system.  The first row
         # encountered becomes the canonical metadata, while every row contributes
         # an RPM tuple (epoch, version, release, arch, etc.) for the download table.
         for row in versions:
-            (pkg_key, epoch, version, release, arch, summary,
-             description, url, time_build, rpm_license, rpm_sourcerpm,
-             size_package, location_href, vendor) = row
+            (pkg_key, epoch, version, release, arch, summary, time_build,
+             description, url, rpm_license, rpm_sourcerpm, vendor,
+             size_package, location_href) = row
             if pkg_data['summary'] is None:
                 pkg_data['summary'] = summary
                 pkg_data['description'] = description
@@ -557,15 +2777,14 @@ class Repoview:
                 pkg_data['rpm_sourcerpm'] = rpm_sourcerpm
                 pkg_data['vendor'] = vendor
 
-            size = _humansize(size_package)
+            size = None
+            if size_package is not None:
+                size = _humansize(size_package)
 
             # Get latest changelog entry for each version
-            query = '''SELECT author, date, changelog
-                         FROM changelog WHERE pkgKey=%d
-                     ORDER BY date DESC LIMIT 1''' % pkg_key
-            ocursor = self.oconn.cursor()
-            ocursor.execute(query)
-            orow = ocursor.fetchone()
+            orow = None
+            if self.fields & CHANGELOG_FIELDS:
+                orow = self.metadata.get_changelog(pkg_key)
             if not orow:
                 author = time_added = changelog = None
             else:
@@ -604,7 +2823,7 @@ class Repoview:
         pkg_tuples = []
 
         for pkgname in pkgnames:
-            pkg_filename = _mkid(PKGFILE % pkgname)
+            pkg_filename = self.pkg_filename(pkgname)
 
             if pkgname in self.written:
                 pkg_tuples.append(self.written[pkgname])
@@ -619,25 +2838,207 @@ class Repoview:
             pkg_tuple = (pkgname, pkg_filename, pkg_data['summary'])
             pkg_tuples.append(pkg_tuple)
 
+            if self.opts.history:
+                self.queue_history(pkgname)
+
             checksum = self.mk_checksum(repo_data, group_data, pkg_data)
             if self.has_changed(pkg_filename, checksum):
                 self.say('Writing package %s\n' % pkg_filename)
-                self.pkg_kid.group_data = group_data
-                self.pkg_kid.pkg_data = pkg_data
-                outfile = os.path.join(self.outdir, pkg_filename)
-                self.pkg_kid = TemplateLoader(self.opts.templatedir)
-
-                tmpl= self.pkg_kid.load( PKGKID )
-
-                stream=tmpl.generate(group_data=group_data, pkg_data=pkg_data, repo_data=repo_data)
-                with open( outfile, "w" ) as f:
-                   f.write( stream.render('xhtml', doctype='xhtml-strict'))
+                self.write_file(pkg_filename,
+                                self.renderer.render(PKGKID,
+                                                     group_data=group_data,
+                                                     pkg_data=pkg_data,
+                                                     repo_data=repo_data,
+                                                     root=self.pkg_root))
                 self.written[pkgname] = pkg_tuple
             else:
                 self.written[pkgname] = pkg_tuple
 
         return pkg_tuples
 
+    def history_filename(self, pkgname):
+        """
+        Return the path of the changelog fragment of a package, which goes
+        next to the package page.
+
+        @param pkgname: the name of the package
+        @type  pkgname: str
+
+        @return: the fragment path, using "/" as separator
+        @rtype:  str
+        """
+        dirname = os.path.dirname(self.pkg_filename(pkgname))
+        if dirname:
+            dirname += '/'
+        return dirname + _mkid(HISTFILE % pkgname)
+
+    def queue_history(self, pkgname):
+        """
+        Check whether the changelog fragment of a package is up to date,
+        and queue it for write_histories if not. Changelogs come with the
+        package builds, so the fragment only changes when the set of pkgIds
+        behind the name does; pkgKeys cannot be used for that, as they are
+        renumbered whenever the repository metadata is regenerated.
+
+        @param pkgname: the name of the package
+        @type  pkgname: str
+
+        @rtype: void
+        """
+        query = """SELECT pkgId, pkgKey
+                     FROM packages
+                    WHERE name='%s' AND %s
+                 ORDER BY pkgId""" % (pkgname.replace("'", "''"), self.exclude)
+        pcursor = self.pconn.cursor()
+        pcursor.execute(query)
+        rows = pcursor.fetchall()
+
+        filename = self.history_filename(pkgname)
+        checksum = self.mk_checksum({'pkgids':  [row[0] for row in rows],
+                                     'version': VERSION})
+        if self.has_changed(filename, checksum):
+            self.histories.append((filename, [row[1] for row in rows]))
+            if len(self.histories) >= HISTBATCH:
+                self.write_histories()
+
+    def write_histories(self):
+        """
+        Write the changelog fragments queued by queue_history, fetching the
+        changelogs of the whole batch with a single scan (see
+        RepoMetadata.get_changelogs).
+
+        @rtype: void
+        """
+        if not self.histories:
+            return
+        pkg_keys = []
+        for (_, keys) in self.histories:
+            pkg_keys.extend(keys)
+        changelogs = self.metadata.get_changelogs(pkg_keys)
+        for (filename, keys) in self.histories:
+            entries = []
+            for pkg_key in keys:
+                entries.extend(changelogs.get(pkg_key, []))
+            self.say('Writing changelog %s\n' % filename)
+            self.write_file(filename, self.mk_history(entries))
+        self.histories = []
+
+    def mk_history(self, entries):
+        """
+        Build a changelog fragment: a bare <div>, which the package page
+        fetches and inserts when asked to (see layout/changelog.js in the
+        default templates). Entries shared by several builds, e.g. by the
+        architectures of the same version, are listed once.
+
+        @param entries: (author, date, changelog) tuples
+        @type  entries: list
+
+        @rtype: bytes
+        """
+        unique = []
+        seen = set()
+        for entry in sorted(entries, key=lambda entry: -entry[1]):
+            if entry not in seen:
+                seen.add(entry)
+                unique.append(entry)
+
+        etb = TreeBuilder()
+        etb.start('div', {'class': 'history'})
+        if unique:
+            etb.start('dl', {})
+        for (author, date, changelog) in unique:
+            # strip the email, but keep the version that follows it
+            author = re.sub(r'\s*<[^>]*>', '', author or '')
+            etb.start('dt', {})
+            etb.data('%s %s' % (time.strftime('%Y-%m-%d',
+                                              time.localtime(int(date))),
+                                author))
+            etb.end('dt')
+            etb.start('dd', {})
+            etb.start('pre', {})
+            etb.data(changelog or '')
+            etb.end('pre')
+            etb.end('dd')
+        if unique:
+            etb.end('dl')
+        else:
+            etb.start('p', {})
+            etb.start('em', {})
+            etb.data('(no changelog entries)')
+            etb.end('em')
+            etb.end('p')
+        etb.end('div')
+        # served as HTML, so no <pre/>
+        return tostring(etb.close(), 'utf-8', short_empty_elements=False)
+
+    def paginate_group(self, group_data, packages):
+        """
+        Split the package listing of a group into pages, if the group is
+        larger than the configured page size. The first page keeps the group
+        filename, the following ones are named after the package closing the
+        previous page: that is a boundary package, so the name survives
+        packages being added right after it, and adding a package only
+        rewrites the page it lands on.
+
+        @param group_data: the dict with group data
+        @type  group_data: dict
+        @param   packages: the tuples returned by do_packages
+        @type    packages: list
+
+        @return: a list of group_data dicts, one per page
+        @rtype:  list
+        """
+        page_size = self.opts.pagesize
+        if not page_size or len(packages) <= page_size:
+            chunks = [packages]
+        else:
+            chunks = _paginate(packages, page_size)
+
+        grp_filename = group_data['filename']
+        grp_base = grp_filename[:-len(GRPFILE % '')]
+        filenames = [grp_filename]
+        for chunk in chunks[:-1]:
+            filenames.append(_mkid(GRPPAGE % (grp_base, chunk[-1][0])))
+
+        pages = []
+        for (index, chunk) in enumerate(chunks):
+            page_data = dict(group_data)
+            page_data['filename']   = filenames[index]
+            page_data['packages']   = chunk
+            page_data['prev_page']  = None
+            page_data['next_page']  = None
+            page_data['page_label'] = None
+            if len(chunks) > 1:
+                if index > 0:
+                    page_data['prev_page'] = filenames[index-1]
+                if index < len(chunks) - 1:
+                    page_data['next_page'] = filenames[index+1]
+                page_data['page_label'] = '%s - %s' % (chunk[0][0],
+                                                       chunk[-1][0])
+            pages.append(page_data)
+        return pages
+
+    def do_group(self, repo_data, group_data):
+        """
+        Write a group page (or one page of a paginated group) if it changed.
+
+        @param  repo_data: the dict with repository data
+        @type   repo_data: dict
+        @param group_data: the dict with group data, as returned by
+                           paginate_group
+        @type  group_data: dict
+
+        @rtype: void
+        """
+        grp_filename = group_data['filename']
+        checksum = self.mk_checksum(repo_data, group_data)
+        if self.has_changed(grp_filename, checksum):
+            # write group file
+            self.say('Writing group %s\n' % grp_filename)
+            self.write_file(grp_filename,
+                            self.renderer.render(GRPKID, group_data=group_data,
+                                                 repo_data=repo_data))
+
     def mk_checksum(self, *args):
         """
         Calculates a deterministic MD5 checksum for the provided data dictionaries.
@@ -677,110 +3078,214 @@ class Repoview:
         """
         # calculate checksum
         scursor = self.sconn.cursor()
-        if filename not in self.state_data:
+        if filename in self.visited:
+            # already seen during this session, e.g. regenerated on demand
+            previous = self.visited[filename]
+        elif filename in self.state_data:
+            # remove it from state_data tracking, so we know we've seen it
+            previous = self.state_data.pop(filename)
+        else:
             # totally new entry
             query = '''INSERT INTO state (filename, checksum)
                                   VALUES ('%s', '%s')''' % (filename, checksum)
             scursor.execute(query)
+            self.visited[filename] = checksum
             return True
-        if self.state_data[filename] != checksum:
+
+        self.visited[filename] = checksum
+        if previous != checksum:
             # old entry, but changed
             query = """UPDATE state
                           SET checksum='%s'
                         WHERE filename='%s'""" % (checksum, filename)
             scursor.execute(query)
-
-            # remove it from state_data tracking, so we know we've seen it
-            del self.state_data[filename]
             return True
         # old entry, unchanged
-        del self.state_data[filename]
         return False
 
-    def remove_stale(self):
+    def file_digest(self, filename):
         """
-        Remove errant stale files from the output directory, left from previous
-        repoview runs.
+        Read a file from the output sink and return its size and sha256.
 
-        @rtype void
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+
+        @return: (size, hexdigest)
+        @rtype:  tuple
         """
-        scursor = self.sconn.cursor()
-        for filename in self.state_data:
-            self.say('Removing stale file %s\n' % filename)
-            fullpath = os.path.join(self.outdir, filename)
-            if os.access(fullpath, os.W_OK):
-                os.unlink(fullpath)
-            query = """DELETE FROM state WHERE filename='%s'""" % filename
-            scursor.execute(query)
+        content = self.sink.read(filename)
+        return (len(content), hashlib.sha256(content).hexdigest())
 
-    def z_handler(self, dbfile):
+    def write_file(self, filename, content):
         """
-        If the database file is compressed, uncompresses it and returns the
-        filename of the uncompressed file.
+        Queue a generated page for writing into the output sink and
+        record its size and digest in the state db. Pages whose content matches what is
+        already on disk are left untouched, so their mtime does not change
+        and mirrors do not pick them up again.
 
-        @param dbfile: the name of the file
-        @type  dbfile: str
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param  content: the page contents
+        @type   content: str or bytes
 
-        @return: the name of the uncompressed file
-        @rtype:  str
+        @rtype: void
         """
-        (junk, ext) = os.path.splitext(dbfile)
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        digest = hashlib.sha256(content).hexdigest()
+        if (self.digests.get(filename) == digest
+                and self.sink.exists(filename, digest)):
+            self.say('Adopting existing %s\n' % filename)
+            return
+
+        # the state db is updated right away, in page order; the write itself
+        # may be left to a background writer and awaited by finalize()
+        self.record_file(filename, len(content), digest)
+        self.sink.write(filename, content, digest)
+
+    def record_file(self, filename, size, digest, changed=True):
+        """
+        Record the size and digest of a file in the state db. The state
+        entry itself must already exist (see has_changed).
 
-        if ext == '.bz2':
-            from bz2 import BZ2File
-            zfd = BZ2File(dbfile)
-        elif ext == '.gz':
-            from gzip import GzipFile
-            zfd = GzipFile(dbfile)
-        elif ext == '.xz':
-            from lzma import LZMAFile
-            zfd = LZMAFile(dbfile)
-        else:
-            # not compressed (or something odd)
-            return dbfile
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param     size: the size of the file in bytes
+        @type      size: int
+        @param   digest: the sha256 of the file contents
+        @type    digest: str
+        @param  changed: whether the file was written during this run
+        @type   changed: bool
 
-        import tempfile
-        (unzfd, unzname) = tempfile.mkstemp('.repoview')
-        self.cleanup.append(unzname)
+        @rtype: void
+        """
+        self.digests[filename] = digest
+        generation = 0
+        if changed:
+            self.changed.append(filename)
+            generation = self.generation
 
-        unzfd = open(unzname, 'wb')
+        scursor = self.sconn.cursor()
+        query = """UPDATE state
+                      SET size=%d, digest='%s', generation=%d
+                    WHERE filename='%s'""" % (size, digest, generation,
+                                               filename)
+        scursor.execute(query)
 
-        while True:
-            data = zfd.read(16384)
-            if not data:
-                break
-            unzfd.write(data)
-        zfd.close()
-        unzfd.close()
+    def fill_digests(self):
+        """
+        Record size and digest for state entries that have none yet, which
+        only happens for pages written by a repoview version that did not
+        track them. Each such page is read once; later runs use the state db.
+        They are recorded with generation 0, as it is unknown when they last
+        changed.
 
-        return unzname
+        @rtype: void
+        """
+        scursor = self.sconn.cursor()
+        scursor.execute("""SELECT filename FROM state WHERE digest IS NULL""")
+        filenames = [row[0] for row in scursor.fetchall()
+                     if self.sink.exists(row[0])]
+        if not filenames:
+            return
+        from concurrent.futures import ThreadPoolExecutor
+        self.say('Computing digests for %d files...' % len(filenames))
+        with ThreadPoolExecutor() as pool:
+            stats = list(pool.map(self.file_digest, filenames))
+        for (filename, (size, digest)) in zip(filenames, stats):
+            self.record_file(filename, size, digest, changed=False)
+        self.say('done\n')
 
-    def setup_comps_groups(self, compsxml):
+    def write_manifest(self):
         """
-        Utility method for parsing comps.xml.
+        Publish MANIFEST, listing every tracked file with its digest, size
+        and the generation it last changed in, and DELTAFILE, listing the
+        files written (+) and removed (-) by this run. Both are built from
+        the state db and replaced atomically; they are left alone when the
+        run changed nothing.
 
-        @param compsxml: the location of comps.xml
-        @type  compsxml: str
+        @rtype: void
+        """
+        manifest = os.path.join(self.outdir, MANIFEST)
+        if not (self.changed or self.removed) and os.path.exists(manifest):
+            return
+        self.say('Writing manifest...')
+        generation = self.generation
+        if not (self.changed or self.removed):
+            generation -= 1
+
+        lines = ['# repoview manifest, generation %d\n' % generation]
+        scursor = self.sconn.cursor()
+        scursor.execute("""SELECT digest, size, generation, filename
+                             FROM state
+                            WHERE digest IS NOT NULL
+                         ORDER BY filename""")
+        for row in scursor.fetchall():
+            lines.append('%s %d %d %s\n' % row)
+        self._replace_file(MANIFEST, ''.join(lines))
+
+        lines = ['# repoview manifest delta, generation %d\n' % generation]
+        for filename in sorted(set(self.changed)):
+            lines.append('+ %s\n' % filename)
+        for filename in sorted(set(self.removed)):
+            lines.append('- %s\n' % filename)
+        self._replace_file(DELTAFILE, ''.join(lines))
+        self.say('done\n')
+
+    def manifest_generation(self):
+        """
+        Read the generation from the header of the MANIFEST published by an
+        earlier run. The run counter in the state db starts over whenever
+        the state db does (--force, --recover, a lost sink), and the
+        published generation must never go backwards.
+
+        @return: the generation, or 0 if there is no readable MANIFEST
+        @rtype:  int
+        """
+        manifest = os.path.join(self.outdir, MANIFEST)
+        try:
+            with open(manifest, encoding='utf-8') as fh:
+                header = fh.readline()
+        except (OSError, ValueError):
+            return 0
+        match = re.match(r'# repoview manifest, generation (\d+)$',
+                         header.rstrip('\n'))
+        if match is None:
+            return 0
+        return int(match.group(1))
+
+    def _replace_file(self, filename, content):
+        """
+        Atomically replace a file in the output directory.
+
+        @param filename: the filename relative to the output directory
+        @type  filename: str
+        @param  content: the new contents
+        @type   content: str
 
         @rtype: void
         """
-        if libcomps is None:
-            raise ImportError('Repoview requires the "libcomps" package to parse comps.xml.')
+        outfile = os.path.join(self.outdir, filename)
+        tmpfile = '%s.tmp' % outfile
+        with open(tmpfile, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmpfile, outfile)
 
-        self.say('Parsing comps.xml...')
-        comps = libcomps.Comps()
-        comps.fromxml_f(compsxml)
-
-        for group in comps.groups:
-            #if not group.uservisible:
-                #continue
-            if not group.packages:
-               continue
-
-            group_filename = _mkid(GRPFILE % group.id)
-            pkg_names = [pkg.name for pkg in group.packages]
-            self.groups.append([ group.name, group_filename, group.desc, pkg_names ])
-        self.say('done\n')
+    def remove_stale(self):
+        """
+        Remove errant stale files from the output sink, left from previous
+        repoview runs.
+
+        @rtype void
+        """
+        scursor = self.sconn.cursor()
+        for filename in self.state_data:
+            self.say('Removing stale file %s\n' % filename)
+            self.sink.remove(filename)
+            self.removed.append(filename)
+            query = """DELETE FROM state WHERE filename='%s'""" % filename
+            scursor.execute(query)
+        self.state_data = {}
 
     def setup_rpm_groups(self):
         """
@@ -812,7 +3317,7 @@ class Repoview:
             self.groups.append([rpmgroup, group_filename, None, pkgnames])
         self.say('done\n')
 
-    def get_latest_packages(self, limit=30):
+    def get_latest_packages(self, limit=LATEST):
         """
         Return necessary data for the latest NN packages.
 
@@ -838,7 +3343,7 @@ class Repoview:
                     WHERE name = '%s'
                     ORDER BY time_build DESC LIMIT 1"""
         for (pkgname,) in pcursor.fetchall():
-            filename = _mkid(PKGFILE % pkgname.replace("'", "''"))
+            filename = self.pkg_filename(pkgname.replace("'", "''"))
 
             pcursor.execute(query % pkgname)
             (version, release, built) = pcursor.fetchone()
@@ -884,20 +3389,133 @@ class Repoview:
         self.say('done\n')
         return letters
 
-    def do_rss(self, repo_data, latest):
+    def render_feeds(self, repo_data, latest):
         """
-        Write the RSS feed.
+        Write the feeds asked for with --feeds, if any of them changed. The
+        entries come from get_feed_items, so only packages new to the feed
+        are queried and rendered.
 
         @param repo_data: the dict containing repository data
         @type  repo_data: dict
-        @param latest:    the list of tuples returned by get_latest_packages
-        @type  latest:    list
+        @param    latest: the list of tuples returned by get_latest_packages
+        @type     latest: list
 
         @rtype: void
         """
-        self.say('Generating rss feed...')
+        feed = latest[:self.opts.feedlength]
+        checksum = self.mk_checksum(repo_data, {'feed': feed})
+        # has_changed() marks every feed file as visited, so formats that are
+        # no longer asked for go away as stale files
+        formats = [fmt for fmt in self.opts.feeds
+                   if self.has_changed(FEEDFILES[fmt], checksum)]
+        if not formats:
+            return
+
+        self.say('Generating feeds...')
+        items = self.get_feed_items(repo_data, feed)
+        for fmt in formats:
+            write_feed = getattr(self, 'do_%s' % fmt)
+            self.write_file(FEEDFILES[fmt], write_feed(repo_data, items))
+        self.say('done\n')
+
+    def get_feed_items(self, repo_data, feed):
+        """
+        Return the feed entries for the given packages. Entries are kept in
+        the feed_items table of the state db, keyed by the identity of the
+        package versions (the pkgIds) and of everything else that goes
+        into them, so an entry is built only once per package update.
+        Entries that dropped out of the feed are forgotten.
+
+        @param repo_data: the dict containing repository data
+        @type  repo_data: dict
+        @param      feed: the (pkgname, filename, version, release, built)
+                          tuples of the packages to list
+        @type       feed: list
+
+        @return: a list of (guid, link, title, summary, built, description)
+                 tuples
+        @rtype:  list
+        """
+        if self.rss_digest is None:
+            with open(os.path.join(self.opts.templatedir, RSSKID), 'rb') as fh:
+                self.rss_digest = hashlib.sha256(fh.read()).hexdigest()
+
+        scursor = self.sconn.cursor()
+        pcursor = self.pconn.cursor()
+        items = []
+        idents = []
+        for (pkgname, filename, _, _, _) in feed:
+            query = """SELECT pkgId
+                         FROM packages
+                        WHERE name='%s' AND %s
+                     ORDER BY pkgId""" % (pkgname.replace("'", "''"),
+                                          self.exclude)
+            pcursor.execute(query)
+            ident = self.mk_checksum({'pkgids':   pcursor.fetchall(),
+                                      'filename': filename,
+                                      'url':      self.opts.url,
+                                      'title':    repo_data['title'],
+                                      'template': self.rss_digest})
+            scursor.execute("""SELECT guid, link, title, summary, built,
+                                      description
+                                 FROM feed_items
+                                WHERE ident='%s'""" % ident)
+            item = scursor.fetchone()
+            if item is None:
+                item = self.mk_feed_item(repo_data, pkgname)
+                scursor.execute("""INSERT OR REPLACE INTO feed_items
+                                        (ident, guid, link, title, summary,
+                                         built, description)
+                                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                (ident,) + item)
+            items.append(item)
+            idents.append(ident)
+
+        scursor.execute("""DELETE FROM feed_items
+                            WHERE ident NOT IN (%s)"""
+                        % ', '.join(["'%s'" % ident for ident in idents]))
+        return items
+
+    def mk_feed_item(self, repo_data, pkgname):
+        """
+        Build the feed entry for a package, rendering its description with
+        rss.kid.
+
+        @param repo_data: the dict containing repository data
+        @type  repo_data: dict
+        @param   pkgname: the name of the package
+        @type    pkgname: str
+
+        @return: (guid, link, title, summary, built, description)
+        @rtype:  tuple
+        """
+        pkg_data = self.get_package_data(pkgname)
+
+        rpm = pkg_data['rpms'][0]
+        (epoch, version, release, arch, built) = rpm[:5]
+        guid = '%s/repoview/%s+%s:%s-%s.%s' % (self.opts.url,
+                                               pkg_data['filename'],
+                                               epoch, version, release, arch)
+        link = '%s/repoview/%s' % (self.opts.url, pkg_data['filename'])
+        title = 'Update: %s-%s-%s' % (pkg_data['name'], version, release)
+        description = self.renderer.render_xml(RSSKID, pkg_data=pkg_data,
+                                               repo_data=repo_data,
+                                               url=self.opts.url)
+        return (guid, link, title, pkg_data['summary'], int(built),
+                description)
+
+    def do_rss(self, repo_data, items):
+        """
+        Build the RSS feed.
+
+        @param repo_data: the dict containing repository data
+        @type  repo_data: dict
+        @param     items: the entries returned by get_feed_items
+        @type      items: list
+
+        @rtype: bytes
+        """
         etb = TreeBuilder()
-        out = os.path.join(self.outdir, RSSFILE)
         etb.start('rss', {'version': '2.0'})
         etb.start('channel', {})
         etb.start('title', {})
@@ -916,29 +3534,20 @@ class Repoview:
         etb.data('Repoview-%s' % repo_data['my_version'])
         etb.end('generator')
 
-        rss_kid = self.pkg_kid.load(RSSKID)
-        for row in latest:
-            pkg_data = self.get_package_data(row[0])
-
-            rpm = pkg_data['rpms'][0]
-            (epoch, version, release, arch, built) = rpm[:5]
+        for (guid, link, title, _, built, description) in items:
             etb.start('item', {})
             etb.start('guid', {})
-            etb.data('%s/repoview/%s+%s:%s-%s.%s' % (self.opts.url,
-                                                     pkg_data['filename'],
-                                                     epoch, version, release,
-                                                     arch))
+            etb.data(guid)
             etb.end('guid')
             etb.start('link', {})
-            etb.data('%s/repoview/%s' % (self.opts.url, pkg_data['filename']))
+            etb.data(link)
             etb.end('link')
             etb.start('pubDate', {})
-            etb.data(time.strftime(ISOFORMAT, time.gmtime(int(built))))
+            etb.data(time.strftime(ISOFORMAT, time.gmtime(built)))
             etb.end('pubDate')
             etb.start('title', {})
-            etb.data('Update: %s-%s-%s' % (pkg_data['name'], version, release))
+            etb.data(title)
             etb.end('title')
-            description = rss_kid.generate(pkg_data=pkg_data, repo_data=repo_data, url=self.opts.url).render()
             etb.start('description', {})
             etb.data(description)
             etb.end('description')
@@ -946,20 +3555,171 @@ class Repoview:
 
         etb.end('channel')
         etb.end('rss')
-        rss = etb.close()
+        return tostring(etb.close(), 'utf-8')
 
-        etree = ElementTree(rss)
-        out = os.path.join(self.outdir, RSSFILE)
-        etree.write(out, 'utf-8')
-        self.say('done\n')
+    def do_atom(self, repo_data, items):
+        """
+        Build the Atom feed.
 
+        @param repo_data: the dict containing repository data
+        @type  repo_data: dict
+        @param     items: the entries returned by get_feed_items
+        @type      items: list
 
-def main():
+        @rtype: bytes
+        """
+        updated = max([item[4] for item in items] or [int(time.time())])
+        etb = TreeBuilder()
+        etb.start('feed', {'xmlns': 'http://www.w3.org/2005/Atom'})
+        etb.start('id', {})
+        etb.data('%s/repoview/%s' % (self.opts.url, ATOMFILE))
+        etb.end('id')
+        etb.start('title', {})
+        etb.data(repo_data['title'])
+        etb.end('title')
+        etb.start('subtitle', {})
+        etb.data('Latest packages for %s' % repo_data['title'])
+        etb.end('subtitle')
+        etb.start('link', {'rel': 'self',
+                           'href': '%s/repoview/%s' % (self.opts.url,
+                                                       ATOMFILE)})
+        etb.end('link')
+        etb.start('link', {'href': '%s/repoview/%s' % (self.opts.url,
+                                                       IDXFILE)})
+        etb.end('link')
+        etb.start('updated', {})
+        etb.data(time.strftime(RFC3339, time.gmtime(updated)))
+        etb.end('updated')
+        etb.start('generator', {'version': repo_data['my_version']})
+        etb.data('Repoview')
+        etb.end('generator')
+
+        for (guid, link, title, summary, built, description) in items:
+            etb.start('entry', {})
+            etb.start('id', {})
+            etb.data(guid)
+            etb.end('id')
+            etb.start('title', {})
+            etb.data(title)
+            etb.end('title')
+            etb.start('link', {'href': link})
+            etb.end('link')
+            etb.start('updated', {})
+            etb.data(time.strftime(RFC3339, time.gmtime(built)))
+            etb.end('updated')
+            if summary:
+                etb.start('summary', {})
+                etb.data(summary)
+                etb.end('summary')
+            etb.start('content', {'type': 'html'})
+            etb.data(description)
+            etb.end('content')
+            etb.end('entry')
+
+        etb.end('feed')
+        return tostring(etb.close(), 'utf-8')
+
+    def do_json(self, repo_data, items):
+        """
+        Build the JSON feed (https://jsonfeed.org/version/1.1).
+
+        @param repo_data: the dict containing repository data
+        @type  repo_data: dict
+        @param     items: the entries returned by get_feed_items
+        @type      items: list
+
+        @rtype: bytes
+        """
+        feed = {
+            'version':       'https://jsonfeed.org/version/1.1',
+            'title':         repo_data['title'],
+            'description':   'Latest packages for %s' % repo_data['title'],
+            'home_page_url': '%s/repoview/%s' % (self.opts.url, IDXFILE),
+            'feed_url':      '%s/repoview/%s' % (self.opts.url, JSONFILE),
+            'items':         [],
+        }
+        for (guid, link, title, summary, built, description) in items:
+            item = {
+                'id':             guid,
+                'url':            link,
+                'title':          title,
+                'content_html':   description,
+                'date_published': time.strftime(RFC3339, time.gmtime(built)),
+            }
+            if summary:
+                item['summary'] = summary
+            feed['items'].append(item)
+        return json.dumps(feed, indent=1, sort_keys=True).encode('utf-8')
+
+
+
+VIEW_OPTIONS = {
+    'output-dir':     'outdir',
+    'state-dir':      'statedir',
+    'template-dir':   'templatedir',
+    'title':          'title',
+    'url':            'url',
+    'exclude-arch':   'xarch',
+    'ignore-package': 'ignore',
+}
+
+def load_views(opts):
     """
-    Parse the options and invoke the repoview class.
+    Read the views file given with --views. Each section describes one view
+    of the repository, using the long option names from VIEW_OPTIONS as
+    keys; output-dir is required. Anything not set falls back to the
+    command-line options, and exclude-arch/ignore-package (whitespace
+    separated) are added to the ones given on the command line. E.g.:
+
+        [x86_64]
+        output-dir = repoview-x86_64
+        title = Updates for x86_64
+        exclude-arch = src i686
+
+    @param opts: OptionParser's opts
+    @type  opts: OptionParser
+
+    @return: a list of opts copies, one per view
+    @rtype:  list
+    """
+    from configparser import ConfigParser, Error as ConfigError
+    config = ConfigParser(interpolation=None)
+    try:
+        if not config.read(opts.views):
+            raise ValueError('Cannot read views file %s' % opts.views)
+    except ConfigError as exc:
+        raise ValueError('Cannot parse views file %s: %s' % (opts.views, exc)) from exc
+
+    views = []
+    outdirs = set()
+    for section in config.sections():
+        view = copy.copy(opts)
+        for (key, value) in config.items(section):
+            if key not in VIEW_OPTIONS:
+                raise ValueError('Unknown option "%s" in view [%s]' % (key, section))
+            dest = VIEW_OPTIONS[key]
+            if dest in ('xarch', 'ignore'):
+                value = getattr(opts, dest) + value.split()
+            setattr(view, dest, value)
+        if not config.has_option(section, 'output-dir'):
+            raise ValueError('View [%s] has no output-dir' % section)
+        if view.outdir in outdirs:
+            raise ValueError('View [%s] reuses output-dir %s' % (section, view.outdir))
+        outdirs.add(view.outdir)
+        views.append(view)
+
+    if not views:
+        raise ValueError('No views defined in %s' % opts.views)
+    return views
+
+def make_parser():
+    """
+    Build the command line parser. Its defaults are what an options object
+    needs to carry for Repoview and RepoMetadata; see default_options.
 
-    @rtype: void
+    @rtype: optparse.OptionParser
     """
+    from optparse import OptionParser
     usage = 'usage: %prog [options] repodir'
     parser = OptionParser(usage=usage, version='%prog ' + VERSION)
     parser.add_option('-i', '--ignore-package', dest='ignore', action='append',
@@ -977,7 +3737,7 @@ def main():
         help='Use an alternative directory with kid templates instead of '
         'the default: %default. The template directory must contain four '
         'required template files: index.kid, group.kid, package.kid, rss.kid '
-        'and the "layout" dir which will be copied into the repoview directory')
+        'and the "layout" dir which will be synced into the repoview directory')
     parser.add_option('-o', '--output-dir', dest='outdir',
         default='repoview',
         help='Create the repoview pages in this subdirectory inside '
@@ -1005,12 +3765,133 @@ def main():
     parser.add_option('-c', '--comps', dest='comps',
         default=None,
         help='Use an alternative comps.xml file (default: off)')
+    parser.add_option('-r', '--recover', dest='recover', action='store_true',
+        default=0,
+        help='If the state db is missing, rebuild it from the pages already '
+        'in the output directory instead of rewriting all of them. Pages '
+        'that come out identical are kept as they are')
+    parser.add_option('-H', '--hashed-dirs', dest='hashdirs',
+        action='store_true', default=0,
+        help='Spread package pages over hashed subdirectories '
+        '(%s/xx/name.html) instead of writing them all into the output '
+        'directory. Pages from a previous run are moved over' % PKGDIR)
+    parser.add_option('-m', '--manifest', dest='manifest', action='store_true',
+        default=0,
+        help='Publish %s (sha256, size, generation and path of every '
+        'generated file) and %s (files written or removed by the last '
+        'run that changed anything), so mirrors can fetch only what '
+        'changed' % (MANIFEST, DELTAFILE))
+    parser.add_option('-j', '--writers', dest='writers', type='int',
+        default=4,
+        help='Write pages from this many background threads, so rendering '
+        'goes on while earlier pages are written out; 0 writes each page '
+        'before rendering the next (default: %default)')
+    parser.add_option('-p', '--page-size', dest='pagesize', type='int',
+        default=0,
+        help='Split group pages with more packages than this into several '
+        'pages of roughly this size. Page boundaries are derived from '
+        'package names, so they stay stable between runs '
+        '(default: 0, do not split)')
+    parser.add_option('-C', '--comps-pages', dest='compspages',
+        action='store_true', default=0,
+        help='Also write a page for every comps category (%s) and '
+        'environment (%s), listing their groups, and link them from the '
+        'index' % (CATFILE % 'id', ENVFILE % 'id'))
+    parser.add_option('-l', '--changelog-history', dest='history',
+        action='store_true', default=0,
+        help='Write the complete changelog of each package into a separate '
+        'fragment next to its page (%s), which the page loads when asked '
+        'to. Fragments are only rewritten when the builds of the package '
+        'change' % (HISTFILE % 'name'))
+    parser.add_option('-F', '--feeds', dest='feeds',
+        default='rss',
+        help='Comma-separated feeds of the latest packages to write when '
+        'a URL is given: rss (%s), atom (%s), json (%s, JSON Feed). '
+        'Entries are kept in the state db, so only new packages are '
+        'rendered (default: %%default)' % (RSSFILE, ATOMFILE, JSONFILE))
+    parser.add_option('-n', '--feed-length', dest='feedlength', type='int',
+        default=LATEST,
+        help='How many packages the feeds list (default: %default)')
+    parser.add_option('-S', '--sink', dest='sink',
+        type='choice', choices=sorted(SINKS), default='dir',
+        help='Where the site goes: "dir" writes plain files into the output '
+        'directory; "tar" and "zip" stream it into %s there, "objects" '
+        'keeps it in a content-addressed store (%s/xx/<sha256>) with %s '
+        'mapping every path to its object. Archives and manifest are '
+        'replaced atomically (default: %%default)'
+        % (ARCHIVE % '<tar|zip>', OBJDIR, OBJMANIFEST))
+    parser.add_option('-R', '--renderer', dest='renderer',
+        type='choice', choices=['compiled', 'genshi'], default='compiled',
+        help='How to render the pages: "compiled" turns the templates into '
+        'Python code, cached in $XDG_CACHE_HOME/repoview, and falls back to '
+        'Genshi for templates or pages it cannot handle; "genshi" always '
+        'uses Genshi (default: %default)')
+    parser.add_option('-w', '--views', dest='views',
+        default=None,
+        help='Generate several views of the repository from a single pass '
+        'over its metadata, as described in this ini-style file: one section '
+        'per view, with output-dir (required), state-dir, template-dir, '
+        'title, url, exclude-arch and ignore-package keys')
+    return parser
+
+def default_options(repodir, **values):
+    """
+    Set up the options for a Repoview session the way main() does for a
+    command line with no options, for tools that drive sessions
+    themselves. Anything else can be given by option dest name, e.g.:
+
+        opts = default_options('/srv/repo', outdir='pages', hashdirs=True)
+        with Repoview(opts) as session:
+            session.run()
+
+    Values are taken as they are, without the checks main() does; feeds is
+    a list of FEEDFILES keys.
+
+    @param repodir: the repository directory
+    @type  repodir: str
+    @param  values: options to set instead of their defaults
+
+    @rtype: optparse.Values
+    """
+    opts = make_parser().get_default_values()
+    opts.repodir = repodir
+    opts.feeds = [fmt for fmt in opts.feeds.split(',') if fmt]
+    for (key, value) in values.items():
+        if not hasattr(opts, key):
+            raise TypeError('Unknown option: %s' % key)
+        setattr(opts, key, value)
+    return opts
+
+def main():
+    """
+    Parse the options and invoke the repoview class.
+
+    @rtype: void
+    """
+    parser = make_parser()
     (opts, args) = parser.parse_args()
     if not args:
         parser.error('Incorrect invocation.')
 
     opts.repodir = args[0]
-    Repoview(opts)
+    if opts.pagesize < 0:
+        parser.error('--page-size cannot be negative')
+    opts.feeds = [fmt for fmt in opts.feeds.split(',') if fmt]
+    for fmt in opts.feeds:
+        if fmt not in FEEDFILES:
+            parser.error('Unknown feed format: %s' % fmt)
+    views = [opts]
+    if opts.views:
+        try:
+            views = load_views(opts)
+        except ValueError as exc:
+            parser.error(str(exc))
+
+    # all views share the same uncompressed databases and parsed comps
+    with RepoMetadata(views[0], cache=len(views) > 1) as metadata:
+        for view in views:
+            with Repoview(view, metadata) as session:
+                session.run()
 
 if __name__ == '__main__':
     main()
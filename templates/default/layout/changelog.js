@@ -0,0 +1,25 @@
+/*
+ * Load the full changelog of a package (see repoview --changelog-history)
+ * into the page when its link is followed, instead of leaving the page.
+ */
+document.addEventListener('DOMContentLoaded', function () {
+    var links = document.querySelectorAll('p.history a');
+    Array.prototype.forEach.call(links, function (link) {
+        link.addEventListener('click', function (event) {
+            var holder = link.parentNode;
+            event.preventDefault();
+            fetch(link.getAttribute('href')).then(function (response) {
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.text();
+            }).then(function (text) {
+                var fragment = document.createElement('div');
+                fragment.innerHTML = text;
+                holder.parentNode.replaceChild(fragment.firstChild, holder);
+            }).catch(function () {
+                window.location.href = link.href;
+            });
+        });
+    });
+});
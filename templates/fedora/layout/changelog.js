@@ -0,0 +1 @@
+../../default/layout/changelog.js
\ No newline at end of file
@@ -0,0 +1,185 @@
+"""
+Check that CompiledRenderer produces the very same pages as Genshi for all
+the shipped template sets.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import repoview
+
+try:
+    import genshi
+except ImportError:
+    genshi = None
+
+TEMPLATES = os.path.join(os.path.dirname(os.path.dirname(
+                                            os.path.abspath(__file__))),
+                         'templates')
+TEMPLATE_SETS = ['default', 'fedora', 'kaos', 'kaos-international']
+
+NASTY = 'Tom & Jerry <tom@example.com> said "hi" > \'bye\''
+
+def mk_rpm(version, arch, loc, author=None, log=None, added=None):
+    return ('0', version, '1.fc40', arch, 1700000000, '12 KiB', loc,
+            author, log, added)
+
+def mk_repo_data(letters='ABZ'):
+    return {
+            'title':      'Test & <Repo>',
+            'letters':    letters,
+            'my_version': repoview.VERSION,
+            }
+
+def mk_pkg_data(**overrides):
+    pkg_data = {
+                'name':          'foo',
+                'filename':      'foo.html',
+                'summary':       'The foo tool',
+                'description':   NASTY,
+                'url':           'http://example.com/?a=1&b="2"',
+                'rpm_license':   'GPLv2+',
+                'rpm_sourcerpm': 'foo-1.0-1.fc40.src.rpm',
+                'vendor':        'Example <Corp>',
+                'history':       'foo.changelog.html',
+                'rpms':          [mk_rpm('1.0', 'x86_64', 'Packages/foo.rpm',
+                                         author=NASTY, log='- fix <b>',
+                                         added=1700000000),
+                                  mk_rpm('1.0', 'src', 'SRPMS/foo.src.rpm')],
+                }
+    pkg_data.update(overrides)
+    return pkg_data
+
+def mk_group_data(**overrides):
+    group_data = {
+                  'name':        'Tools & <Utilities>',
+                  'description': NASTY,
+                  'filename':    'tools.group.html',
+                  'packages':    [('foo', 'foo.html', 'The foo tool'),
+                                  ('bar', 'bar.html', NASTY)],
+                  'prev_page':   None,
+                  'next_page':   None,
+                  'page_label':  None,
+                  }
+    group_data.update(overrides)
+    return group_data
+
+def mk_index_args(**overrides):
+    repo_data = mk_repo_data()
+    latest = [('foo', 'foo.html', '1.0', '1.fc40', 1700000000),
+              ('b&r', 'b_r.html', '2<0', '"1"', 1600000000)]
+    groups = [('Tools & <Utilities>', 'tools.group.html', NASTY, ['foo'])]
+    args = {
+            'repo_data':    repo_data,
+            'url':          None,
+            'groups':       groups,
+            'categories':   [('Cat "1"', 'cat1.category.html', NASTY)],
+            'environments': [],
+            'latest':       latest,
+            }
+    args.update(overrides)
+    repo_data['latest'] = args['latest']
+    repo_data['groups'] = args['groups']
+    return args
+
+# (name, template, variables) of the pages rendered for every template set
+CASES = [
+    ('package', repoview.PKGKID,
+     lambda: {'repo_data':  mk_repo_data(),
+              'group_data': mk_group_data(),
+              'pkg_data':   mk_pkg_data(),
+              'root':       '../'}),
+    ('package-nones', repoview.PKGKID,
+     lambda: {'repo_data':  mk_repo_data(),
+              'group_data': mk_group_data(),
+              'pkg_data':   mk_pkg_data(url=None, vendor=None,
+                                        rpm_license=None, description=None,
+                                        history=None,
+                                        rpms=[(None, '1.0', '1', 'noarch',
+                                               1700000000, None, 'a.rpm',
+                                               None, None, None)]),
+              'root':       ''}),
+    ('package-empty', repoview.PKGKID,
+     lambda: {'repo_data':  mk_repo_data(letters=''),
+              'group_data': mk_group_data(),
+              'pkg_data':   mk_pkg_data(rpms=[], history=None),
+              'root':       ''}),
+    ('group', repoview.GRPKID,
+     lambda: {'repo_data':  mk_repo_data(),
+              'group_data': mk_group_data()}),
+    ('group-paged', repoview.GRPKID,
+     lambda: {'repo_data':  mk_repo_data(),
+              'group_data': mk_group_data(prev_page='tools.group.html',
+                                          next_page='tools+z.group.html',
+                                          page_label='bar - foo')}),
+    ('group-empty', repoview.GRPKID,
+     lambda: {'repo_data':  mk_repo_data(letters=''),
+              'group_data': mk_group_data(packages=[], description=None)}),
+    ('index', repoview.IDXKID,
+     lambda: mk_index_args(url='http://example.com/repo?a&b')),
+    ('index-empty', repoview.IDXKID,
+     lambda: mk_index_args(groups=[], categories=[], latest=[])),
+]
+
+@unittest.skipIf(genshi is None, 'genshi is not installed')
+class CompiledRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def renderers(self, template_set):
+        templatedir = os.path.join(TEMPLATES, template_set)
+        return (repoview.GenshiRenderer(templatedir),
+                repoview.CompiledRenderer(templatedir, self.cachedir))
+
+    def test_same_output(self):
+        for template_set in TEMPLATE_SETS:
+            (slow, fast) = self.renderers(template_set)
+            for (name, kid, mk_data) in CASES:
+                with self.subTest(template_set=template_set, page=name):
+                    self.assertIsNotNone(fast.get_function(kid))
+                    self.assertEqual(fast.render(kid, **mk_data()),
+                                     slow.render(kid, **mk_data()))
+            self.assertEqual(fast.fallbacks, 0)
+
+    def test_cached_code(self):
+        for template_set in TEMPLATE_SETS:
+            (slow, _) = self.renderers(template_set)
+            for (name, kid, mk_data) in CASES:
+                # a fresh renderer picks the code up from the cache
+                (_, fast) = self.renderers(template_set)
+                with self.subTest(template_set=template_set, page=name):
+                    self.assertEqual(fast.render(kid, **mk_data()),
+                                     slow.render(kid, **mk_data()))
+
+    def test_markup_falls_back(self):
+        markup = genshi.Markup('<em>already</em> &amp; escaped')
+        for template_set in TEMPLATE_SETS:
+            (slow, fast) = self.renderers(template_set)
+            cases = [(repoview.PKGKID,
+                      {'repo_data':  mk_repo_data(),
+                       'group_data': mk_group_data(),
+                       'pkg_data':   mk_pkg_data(description=markup,
+                                                 summary=markup),
+                       'root':       ''}),
+                     (repoview.GRPKID,
+                      {'repo_data':  mk_repo_data(),
+                       'group_data': mk_group_data(name=markup,
+                                                   description=markup)})]
+            for (kid, data) in cases:
+                with self.subTest(template_set=template_set, kid=kid):
+                    fallbacks = fast.fallbacks
+                    self.assertEqual(fast.render(kid, **data),
+                                     slow.render(kid, **data))
+                    self.assertEqual(fast.fallbacks, fallbacks + 1)
+
+if __name__ == '__main__':
+    unittest.main()
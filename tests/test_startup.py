@@ -0,0 +1,49 @@
+"""
+Check that importing repoview stays cheap: the optional dependencies and
+the heavier standard modules are only imported by the runs that need them.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LAZY_MODULES = ['genshi', 'rpm', 'libcomps', 'tarfile', 'zipfile',
+                'concurrent.futures', 'ast', 'textwrap', 'configparser']
+
+def run_python(*args):
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    return subprocess.run([sys.executable] + list(args), cwd=TOPDIR, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+class StartupTest(unittest.TestCase):
+
+    def test_import_profile(self):
+        proc = run_python('-X', 'importtime', '-c', 'import repoview')
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        imported = set()
+        for line in proc.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                imported.add(line.rsplit('|', 1)[1].strip())
+        self.assertIn('repoview', imported)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, imported)
+
+    def test_version_without_dependencies(self):
+        # None in sys.modules makes any import of them fail
+        code = ('import runpy, sys\n'
+                'sys.modules["genshi"] = None\n'
+                'sys.modules["rpm"] = None\n'
+                'sys.modules["libcomps"] = None\n'
+                'sys.argv = ["repoview.py", "--version"]\n'
+                'runpy.run_path("repoview.py", run_name="__main__")\n')
+        proc = run_python('-c', code)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+        self.assertIn('repoview.py', proc.stdout)
+
+if __name__ == '__main__':
+    unittest.main()